@@ -105,7 +105,6 @@ if __name__ == "__main__":
     st.set_page_config(page_title='Taskbreakdown', page_icon='', initial_sidebar_state='expanded', layout='wide', menu_items={'Report a Bug':'https://forms.gle/C8Zv8hzvYhPPvDW16'})
     login_status_container = st.container()
     initial_display_elements()
-    db, cursor = db_funcs.initialize_database()
 
     if 'user_info' not in st.session_state:
         st.session_state['credentials'] = None
@@ -113,22 +112,22 @@ if __name__ == "__main__":
         st.session_state['variables_initialised'] = False
 
     if st.session_state['user_info']:
-        if not db_funcs.is_user_present(cursor, st.session_state['user_info']['email']):
-            db_funcs.save_user(cursor, db, st.session_state['user_info']['email'], st.session_state['user_info'].get('name', 'User'), st.session_state['user_info'].get('picture', ''))
-
         if not st.session_state['variables_initialised']:
             utils.initialize_variables()
             st.session_state['calendar_service'] = utils.get_calendar_service()
             st.session_state['timezone'] = utils.get_user_timezone(st.session_state['calendar_service'])
-            st.session_state['task_ids_generated'] = db_funcs.check_if_google_tasks_are_created(cursor, st.session_state['user_info']['email'])
-            st.session_state['plan'] = db_funcs.fetch_plan_if_generated(cursor, st.session_state['user_info']['email'])
-            if st.session_state['plan']:
-                first_entry = st.session_state['plan'][0]
-                last_entry = st.session_state['plan'][-1]
-                st.session_state['start_date'] = datetime.datetime.strptime(first_entry['date'], "%Y-%m-%d").date()
-                st.session_state['end_date'] = datetime.datetime.strptime(last_entry['date'], "%Y-%m-%d").date()
-                st.session_state['start_time'] = datetime.datetime.strptime(first_entry['start_time'], "%H:%M:%S").time()
-                st.session_state['end_time'] = datetime.datetime.strptime(first_entry['end_time'], "%H:%M:%S").time()
+            with db_funcs.get_connection() as (db, cursor):
+                if not db_funcs.is_user_present(cursor, st.session_state['user_info']['email']):
+                    db_funcs.save_user(cursor, db, st.session_state['user_info']['email'], st.session_state['user_info'].get('name', 'User'), st.session_state['user_info'].get('picture', ''))
+                st.session_state['task_ids_generated'] = db_funcs.check_if_google_tasks_are_created(cursor, st.session_state['user_info']['email'])
+                st.session_state['plan'] = db_funcs.fetch_plan_if_generated(cursor, st.session_state['user_info']['email'])
+                plan_bounds = db_funcs.fetch_plan_bounds(cursor, st.session_state['user_info']['email'])
+            if plan_bounds:
+                start_date, end_date, start_time, end_time = plan_bounds
+                st.session_state['start_date'] = start_date
+                st.session_state['end_date'] = end_date
+                st.session_state['start_time'] = datetime.datetime.strptime(start_time, "%H:%M:%S").time()
+                st.session_state['end_time'] = datetime.datetime.strptime(end_time, "%H:%M:%S").time()
         
         with login_status_container:
             st.success(f"Welcome {st.session_state['user_info']['name']}. Setup is ready! You can now head onto the Todolist tab, to talk to the assistant :)")
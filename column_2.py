@@ -1,14 +1,14 @@
 """Contains layout and functions for generating a plan, and sending the plan to the calander."""
 import streamlit as st
 from logzero import logger
-import datetime
 
 import helper.llm_utils as llm_utils
 import helper.utils as utils
 import helper.database_functions as db_funcs
+import helper.google_sync as google_sync
     
 
-def _contents_of_column_2(db, cursor):
+def _contents_of_column_2():
     """
     Contains functions and layout for the 2nd column displayed on Todolist Tab.
     """
@@ -24,13 +24,38 @@ def _contents_of_column_2(db, cursor):
     st.info("Click Generate plan, to view the structure of the plan on a day to day basis.")
     
     if st.button("Generate and View plan"):
-        prompt = f"Using the previous messages as context. Generate a detailed plan starting from date {st.session_state['start_date']} to {st.session_state['end_date']} scheduled each day from start_time {st.session_state['start_time']} to {st.session_state['end_time']}"
+        if st.session_state['start_date'] > st.session_state['end_date']:
+            st.error("The start date is after the end date, please fix the timeline in the sidebar.")
+            st.stop()
         with st.spinner('Generating Plan... please wait'):
-            response_text = llm_utils.generate_plan_response(prompt, st.session_state['plan_model'], db, cursor)
-            st.session_state['plan'] = llm_utils.parse_plan_response(response_text)
-            db_funcs.save_plan(cursor, db, st.session_state['user_info']['email'], st.session_state['plan'])
-            st.toast("The plan is generated, you can now talk to the agent, and sync your plans to calendar, and google tasks!")
-            logger.debug(f"The plan for user {st.session_state['user_info']['email']} looks like this\n {st.session_state['plan']}")
+            progress_container = st.empty()
+            generated_days = []
+
+            def _show_generated_days(days):
+                generated_days.extend(days)
+                with progress_container.container(height=300):
+                    st.json(sorted(generated_days, key=lambda day: day['date']), expanded=True)
+
+            plan, failed_chunks = llm_utils.generate_plan(
+                llm_utils.get_model('plan'),
+                st.session_state['start_date'],
+                st.session_state['end_date'],
+                st.session_state['start_time'],
+                st.session_state['end_time'],
+                on_days=_show_generated_days)
+            progress_container.empty()
+            # Saving marks days missing from the plan as removed, and the next sync deletes their tasks and events,
+            # so an incomplete plan never replaces the previous one.
+            if failed_chunks or not plan:
+                for chunk_start, chunk_end in failed_chunks:
+                    st.error(f"The plan from {chunk_start} to {chunk_end} could not be generated.")
+                st.error("The plan was not generated completely, your previous plan is kept. Please try again.")
+            else:
+                st.session_state['plan'] = plan
+                with db_funcs.get_connection() as (db, cursor):
+                    db_funcs.save_plan(cursor, db, st.session_state['user_info']['email'], st.session_state['plan'])
+                st.toast("The plan is generated, you can now talk to the agent, and sync your plans to calendar, and google tasks!")
+                logger.debug(f"The plan for user {st.session_state['user_info']['email']} looks like this\n {st.session_state['plan']}")
     
     if st.session_state['plan']:
         st.toast("Plan has been generated")
@@ -43,19 +68,25 @@ def _contents_of_column_2(db, cursor):
     st.info("Click Send to Calendar, for the detailed plan to be synced to calendar.")
     if st.button("Send plan to Calendar :spiral_calendar_pad:"):
         with st.spinner("Syncing plan to Calendar..."):
-            service = utils.get_calendar_service()
+            service = st.session_state['calendar_service'] or utils.get_calendar_service()
             if service:
-                timezone = utils.get_user_timezone(service)
+                timezone = st.session_state.get('timezone') or utils.get_user_timezone(service)
                 st.write(f"Your timezone is: {timezone}")
+                email = st.session_state['user_info']['email']
+                with db_funcs.get_connection() as (db, cursor):
+                    synced_events = db_funcs.fetch_event_ids(cursor, email)
+                progress_bar = st.progress(0, text="Syncing calendar events...")
+                event_ids, counts, errors = google_sync.sync_plan_to_calendar(
+                    service,
+                    st.session_state['plan'],
+                    timezone,
+                    synced_events,
+                    on_progress=lambda completed, total: progress_bar.progress(completed / total, text=f"Synced {completed} of {total} changed days"))
+                progress_bar.progress(1.0, text="Calendar is up to date")
+                if event_ids != synced_events:
+                    with db_funcs.get_connection() as (db, cursor):
+                        db_funcs.save_event_ids(cursor, db, email, event_ids)
                 logger.debug(f"The plan is synced to calendar")
-                for day in st.session_state['plan']:
-                    start_datetime = datetime.datetime.strptime(f"{day['date']} {day['start_time']}", "%Y-%m-%d %H:%M:%S")
-                    end_datetime = datetime.datetime.strptime(f"{day['date']} {day['end_time']}", "%Y-%m-%d %H:%M:%S")
-                    calendar_event = utils._create_calendar_event(
-                        service,
-                        start_datetime,
-                        end_datetime,
-                        day["goal"],
-                        day["task"],
-                        timezone)
-                    st.write(f"Event created: {calendar_event.get('htmlLink')}")
+                st.success(f"Calendar synced: {counts['created']} created, {counts['updated']} updated, {counts['deleted']} removed, {counts['unchanged']} unchanged.")
+                for date, error in errors.items():
+                    st.error(f"Event for {date} could not be synced: {error}")
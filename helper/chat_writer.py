@@ -0,0 +1,118 @@
+"""Contains a write-behind queue that saves chat messages of every session in batched transactions"""
+import atexit
+import queue
+import threading
+from concurrent.futures import Future
+
+import streamlit as st
+from logzero import logger
+
+import helper.database_functions as db_funcs
+
+
+class ChatWriter:
+    """
+    Saves chat messages on a background thread. Messages queued by all sessions within `flush_interval` seconds
+    are written with one multi-row INSERT and one commit.
+
+    args:
+    pool: connection pool the writer borrows a connection from for every batch.
+    flush_interval: seconds the writer waits for more messages before committing a batch.
+    max_batch: number of messages after which a batch is committed without waiting.
+    """
+    def __init__(self, pool, flush_interval: float = 0.5, max_batch: int = 200):
+        self._pool = pool
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="chat-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, rows: list) -> list:
+        """
+        Queues (email, role, content) rows and returns a future of the saved message id for each row.
+        """
+        if self._closed:
+            raise RuntimeError("Chat writer is closed")
+        futures = [Future() for _ in rows]
+        for row, future in zip(rows, futures):
+            self._queue.put((row, future))
+        return futures
+
+    def flush(self, timeout: float = None):
+        """
+        Blocks until every message queued so far is saved.
+        """
+        done = Future()
+        self._queue.put((None, done))
+        done.result(timeout=timeout)
+
+    def close(self, timeout: float = 30):
+        """
+        Saves the queued messages and stops the writer, registered to run at interpreter shutdown.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.error(f"Chat writer did not finish within {timeout}s, {self._queue.qsize()} messages may be lost")
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            try:
+                while len(batch) < self.max_batch:
+                    batch.append(self._queue.get(timeout=self.flush_interval))
+            except queue.Empty:
+                pass
+            if None in batch:
+                stopping = True
+                batch = [item for item in batch if item is not None]
+                batch.extend(self._drain())
+            self._write(batch)
+
+    def _drain(self) -> list:
+        items = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return items
+            if item is not None:
+                items.append(item)
+
+    def _write(self, batch: list):
+        rows = [row for row, _ in batch if row is not None]
+        futures = [future for row, future in batch if row is not None]
+        try:
+            message_ids = []
+            if rows:
+                with self._pool.connection() as connection:
+                    cursor = connection.cursor()
+                    message_ids = db_funcs.save_chat_messages(cursor, connection, rows)
+                logger.debug(f"Chat writer saved {len(rows)} messages in one transaction")
+        except Exception as e:
+            logger.error(f"Chat writer failed to save {len(rows)} messages: {e}")
+            for future in futures:
+                future.set_exception(e)
+        else:
+            for future, message_id in zip(futures, message_ids):
+                future.set_result(message_id)
+        # Flush markers are resolved after the messages queued before them.
+        for row, future in batch:
+            if row is None:
+                future.set_result(None)
+
+
+@st.cache_resource(show_spinner=False)
+def get_chat_writer() -> ChatWriter:
+    """
+    Creates the chat writer once per process, so the messages of every session are batched together.
+    """
+    writer = ChatWriter(db_funcs.get_connection_pool(), flush_interval=st.secrets.get('chat_write_behind_flush_in_secs', 0.5))
+    atexit.register(writer.close)
+    return writer
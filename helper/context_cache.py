@@ -0,0 +1,126 @@
+"""Contains the context cache, which holds the static prefix of requests once and refers to it by handle"""
+import datetime
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import streamlit as st
+import google.generativeai as genai
+from logzero import logger
+
+import helper.genai_clients as genai_clients
+import helper.token_estimator as token_estimator
+
+# Cached models are replaced this many seconds before their prefix expires, so no request refers to an expired handle.
+REFRESH_MARGIN_IN_SECS = 60
+
+
+class LocalContextStore:
+    """
+    Keeps prefixes in memory and builds models that prepend them to every request, standing in for Gemini's cached content API.
+    That API needs google-generativeai 0.7 or later and prefixes of at least 32768 tokens, which the summarised
+    chat context never reaches, so no remote store is provided.
+    """
+    def create(self, spec: dict, contents: list, ttl: datetime.timedelta, api_key: str):
+        return None, _PrefixedModel(genai_clients.bind_client(genai.GenerativeModel(**spec), api_key), contents)
+
+    def delete(self, handle):
+        pass
+
+
+class _PrefixedModel:
+    def __init__(self, model: genai.GenerativeModel, prefix: list):
+        self._model = model
+        self._prefix = list(prefix)
+
+    def generate_content(self, contents, **kwargs):
+        return self._model.generate_content(self._prefix + list(contents), **kwargs)
+
+    def count_tokens(self, contents):
+        return self._model.count_tokens(self._prefix + list(contents))
+
+    def __getattr__(self, name):
+        return getattr(self._model, name)
+
+
+_STORES = {
+    'local': LocalContextStore,
+}
+
+
+class ContextCache:
+    """
+    Keeps a model per (api key, model spec, prefix) whose system instruction and prefix messages are held by `store`,
+    reused until the prefix is about to expire. Least recently used models beyond `max_entries` are dropped.
+
+    args:
+    store: LocalContextStore, or any object with the same create and delete methods.
+    ttl_in_secs: lifetime of a cached prefix.
+    min_tokens: prefixes estimated below this are not cached.
+    max_entries: number of cached prefixes kept.
+    """
+    def __init__(self, store, ttl_in_secs: float = 3600, min_tokens: int = 0, max_entries: int = 256):
+        self.store = store
+        self.ttl = datetime.timedelta(seconds=ttl_in_secs)
+        self.min_tokens = min_tokens
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def model_for(self, spec_name: str, spec: dict, prefix: list, api_key: str):
+        """
+        Returns a model that holds the spec's system instruction and the prefix messages,
+        or None if the prefix is too small to be cached or could not be stored.
+        """
+        estimator = token_estimator.get_token_estimator()
+        tokens = estimator.estimate([{"parts": [spec['system_instruction']]}] + prefix)
+        if tokens < self.min_tokens:
+            return None
+        key = hashlib.sha256(json.dumps(
+            [api_key, spec_name, spec['system_instruction'], [message["parts"] for message in prefix]],
+            default=str).encode('utf-8')).hexdigest()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] - now > REFRESH_MARGIN_IN_SECS:
+                self._entries.move_to_end(key)
+                return entry[2]
+        try:
+            handle, model = self.store.create(spec, prefix, self.ttl, api_key)
+        except Exception:
+            logger.warning(f"Context of about {tokens} tokens could not be cached for {spec_name}", exc_info=True)
+            return None
+        logger.info(f"Cached a context of about {tokens} tokens for {spec_name}")
+        with self._lock:
+            self._entries[key] = (now + self.ttl.total_seconds(), handle, model)
+            self._entries.move_to_end(key)
+            evicted = []
+            while len(self._entries) > self.max_entries:
+                evicted.append(self._entries.popitem(last=False)[1][1])
+        for handle in evicted:
+            self._delete(handle)
+        return model
+
+    def _delete(self, handle):
+        try:
+            self.store.delete(handle)
+        except Exception:
+            logger.warning("Cached context could not be deleted, it expires on its own", exc_info=True)
+
+
+@st.cache_resource(show_spinner=False)
+def get_context_cache():
+    """
+    Creates the context cache once per process if the `context_cache_backend` secret is 'local', else returns None.
+    """
+    store_name = st.secrets.get('context_cache_backend')
+    if not store_name:
+        return None
+    if store_name not in _STORES:
+        raise ValueError(f"Unknown context_cache_backend '{store_name}', expected one of {list(_STORES)}")
+    return ContextCache(
+        _STORES[store_name](),
+        ttl_in_secs=st.secrets.get('context_cache_ttl_in_secs', 3600),
+        min_tokens=st.secrets.get('context_cache_min_tokens', 0))
@@ -0,0 +1,113 @@
+"""Contains the conversation context kept in the session state, with a running token total"""
+from collections import deque
+from concurrent.futures import Future
+
+import helper.token_estimator as token_estimator
+
+
+class ConversationContext:
+    """
+    Ring buffer of the messages the model is given as context, along with a running token estimate.
+    Appending updates the total in O(1), and trimming evicts from the head without copying the buffer.
+
+    args:
+    messages: initial messages, dicts with "role" and "parts".
+    max_messages: optional bound on the number of messages kept, older messages are evicted first.
+    """
+    def __init__(self, messages: list = None, max_messages: int = None):
+        self._estimator = token_estimator.get_token_estimator()
+        self._messages = deque()
+        self._token_counts = deque()
+        # chat_messages ids of the messages, a Future while a write-behind save is pending, None for messages that aren't saved.
+        self._ids = deque()
+        self.max_messages = max_messages
+        self.total_tokens = 0
+        # Incremented on clear, lets background work started on an older history detect that it is stale.
+        self.generation = 0
+        for message in messages or []:
+            self.append(message)
+
+    def append(self, message: dict):
+        """
+        Adds a message at the tail, evicting the oldest message if max_messages is reached.
+        """
+        if self.max_messages and len(self._messages) >= self.max_messages:
+            self._pop_head()
+        # Only role and parts are accepted by generate_content, the id of saved messages is kept alongside.
+        self._ids.append(message.get("id"))
+        message = {"role": message["role"], "parts": message["parts"]}
+        tokens = self._estimator.estimate_message(message)
+        self._messages.append(message)
+        self._token_counts.append(tokens)
+        self.total_tokens += tokens
+
+    def evict(self, keep_last: int) -> list:
+        """
+        Removes all but the latest `keep_last` messages and returns the removed messages, oldest first.
+        """
+        evicted = []
+        while len(self._messages) > keep_last:
+            evicted.append(self._pop_head())
+        return evicted
+
+    def evict_oldest(self, count: int) -> list:
+        """
+        Removes the oldest `count` messages and returns them, oldest first.
+        """
+        return [self._pop_head() for _ in range(min(count, len(self._messages)))]
+
+    def assign_ids(self, message_ids: list):
+        """
+        Sets the ids of the latest len(message_ids) messages, once they are saved. Ids may be futures of ids.
+        """
+        for offset, message_id in enumerate(reversed(message_ids), start=1):
+            if offset <= len(self._ids):
+                self._ids[-offset] = message_id
+
+    def oldest_ids(self, count: int) -> list:
+        """
+        Returns the ids of the oldest `count` messages, oldest first. Ids of pending saves are still futures,
+        pass the list to resolve_ids once they are needed.
+        """
+        return list(self._ids)[:count]
+
+    @staticmethod
+    def resolve_ids(message_ids: list, timeout: float = None) -> list:
+        """
+        Returns the saved ids of message_ids, waiting up to `timeout` seconds for each pending save.
+        Messages that aren't saved, or failed to save, are left out.
+        """
+        resolved = []
+        for message_id in message_ids:
+            if isinstance(message_id, Future):
+                try:
+                    message_id = message_id.result(timeout=timeout)
+                except Exception:
+                    message_id = None
+            if message_id is not None:
+                resolved.append(message_id)
+        return resolved
+
+    def _pop_head(self) -> dict:
+        self.total_tokens -= self._token_counts.popleft()
+        self._ids.popleft()
+        return self._messages.popleft()
+
+    def messages(self) -> list:
+        """
+        Returns the messages as a list, in the format accepted by generate_content.
+        """
+        return list(self._messages)
+
+    def clear(self):
+        self._messages.clear()
+        self._token_counts.clear()
+        self._ids.clear()
+        self.total_tokens = 0
+        self.generation += 1
+
+    def __iter__(self):
+        return iter(self._messages)
+
+    def __len__(self):
+        return len(self._messages)
@@ -1,94 +1,160 @@
 import streamlit as st
 import psycopg2
+import psycopg2.extras
 import json
+from contextlib import contextmanager
 from logzero import logger
-import datetime
 
-def initialize_database():
-    database_url = st.secrets["database_url"]
-    connection = psycopg2.connect(database_url)
-    cursor = connection.cursor()
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS users (
-        email TEXT PRIMARY KEY,
-        name TEXT,
-        picture TEXT
-    )
-    ''')
+from helper.db_pool import ConnectionPool
+from helper.migrations import run_migrations
 
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS goal_plan (
-        email TEXT PRIMARY KEY,
-        plan JSONB,
-        task_ids JSONB,
-        FOREIGN KEY(email) REFERENCES users(email)
+@st.cache_resource(show_spinner=False)
+def get_connection_pool() -> ConnectionPool:
+    """
+    Creates the connection pool once per process, it is shared by every session and rerun.
+    Pending schema migrations are applied when the pool is first built, so reruns only borrow connections.
+    """
+    pool = ConnectionPool(
+        st.secrets["database_url"],
+        min_connections=st.secrets.get("db_pool_min_connections", 1),
+        max_connections=st.secrets.get("db_pool_max_connections", 10),
+        timeout=st.secrets.get("db_pool_timeout_in_secs", 10),
     )
-    ''')
+    try:
+        with pool.connection() as connection:
+            run_migrations(connection)
+    except Exception:
+        pool.close()
+        raise
+    logger.info("Database connection pool is ready")
+    return pool
 
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS chat_messages (
-        id SERIAL PRIMARY KEY,
-        email TEXT,
-        role TEXT,
-        parts TEXT,
-        timestamp TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY(email) REFERENCES users(email)
-    )
-    ''')
+@contextmanager
+def get_connection():
+    """
+    Borrows a connection from the shared pool and returns it when the block exits.
 
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS summaries (
-        id SERIAL PRIMARY KEY,
-        email TEXT,
-        summary TEXT,
-        timestamp TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY(email) REFERENCES users(email)
-    )
-    ''')
+    yields
+    connection, cursor: same pair that is passed into the functions of this module.
+    """
+    with get_connection_pool().connection() as connection:
+        cursor = connection.cursor()
+        try:
+            yield connection, cursor
+        finally:
+            cursor.close()
 
-    connection.commit()
-    return connection, cursor
+def get_pool_stats() -> dict:
+    """Returns pool size and wait time metrics of the shared connection pool."""
+    return get_connection_pool().stats()
 
 def check_if_google_tasks_are_created(cursor, email:str) -> bool:
-    cursor.execute('SELECT task_ids FROM goal_plan WHERE email=%s', (email,))
-    result = cursor.fetchone()
-    return result is not None and result[0] is not None
+    cursor.execute('SELECT EXISTS (SELECT 1 FROM plan_days WHERE email=%s AND task_id IS NOT NULL)', (email,))
+    return cursor.fetchone()[0]
 
-def fetch_plan_if_generated(cursor, email:str):
-    cursor.execute('SELECT plan FROM goal_plan WHERE email=%s', (email,))
-    result = cursor.fetchone()
-    if result:
-        return result[0]
-    return None
+def fetch_plan_if_generated(cursor, email:str, start_date=None, end_date=None):
+    """
+    Returns the days of the user's plan ordered by date, optionally only the days from start_date to end_date (both included).
+    Returns None if no plan is saved.
+    """
+    query = 'SELECT date, task, goal, start_time, end_time FROM plan_days WHERE email=%s AND in_plan'
+    params = [email]
+    if start_date:
+        query += ' AND date >= %s'
+        params.append(start_date)
+    if end_date:
+        query += ' AND date <= %s'
+        params.append(end_date)
+    cursor.execute(query + ' ORDER BY date', params)
+    rows = cursor.fetchall()
+    if not rows:
+        return None
+    return [{'date': date.strftime('%Y-%m-%d'), 'task': task, 'goal': goal, 'start_time': start_time, 'end_time': end_time}
+            for date, task, goal, start_time, end_time in rows]
 
-def save_plan(cursor, connection, email: str, plan: json):
-    cursor.execute('INSERT INTO goal_plan (email, plan) VALUES (%s, %s) ON CONFLICT (email) DO UPDATE SET plan = EXCLUDED.plan', (email, json.dumps(plan)))
-    connection.commit()
+def fetch_plan_bounds(cursor, email:str):
+    """
+    Returns the start_date, end_date, start_time and end_time of the user's plan, taken from its first and last days.
+    Returns None if no plan is saved.
+    """
+    cursor.execute('''
+        SELECT first_day.date, last_day.date, first_day.start_time, first_day.end_time
+        FROM (SELECT date, start_time, end_time FROM plan_days WHERE email=%(email)s AND in_plan ORDER BY date ASC LIMIT 1) AS first_day,
+             (SELECT date FROM plan_days WHERE email=%(email)s AND in_plan ORDER BY date DESC LIMIT 1) AS last_day
+    ''', {'email': email})
+    return cursor.fetchone()
 
-def fetch_task_ids(cursor, email: str):
-    cursor.execute('SELECT task_ids FROM goal_plan WHERE email=%s', (email,))
-    result = cursor.fetchone()
-    if result and result[0]:
-        if isinstance(result[0], dict):
-            return result[0]
-        return json.loads(result[0])
-    return {}
-
-def save_task_ids(cursor, connection, email: str, task_id: str, date: datetime):
-    # logger.debug("Tasks are being saved")
-    task_date = date.strftime('%Y-%m-%d')
-    task_id_entry = {task_date: task_id}
-    
-    # Insert or update task_ids, handling NULL task_ids by setting it to the new entry.
+def save_plan(cursor, connection, email: str, plan: list):
+    """
+    Upserts every day of the plan, rows are only rewritten if the day changed.
+    Days no longer in the plan are removed, unless a task or event synced for them still has to be deleted.
+    """
+    dates = [day['date'] for day in plan]
+    if plan:
+        psycopg2.extras.execute_values(cursor, '''
+            INSERT INTO plan_days (email, date, in_plan, task, goal, start_time, end_time) VALUES %s
+            ON CONFLICT (email, date) DO UPDATE
+            SET in_plan = TRUE, task = EXCLUDED.task, goal = EXCLUDED.goal, start_time = EXCLUDED.start_time, end_time = EXCLUDED.end_time
+            WHERE (plan_days.in_plan, plan_days.task, plan_days.goal, plan_days.start_time, plan_days.end_time)
+                IS DISTINCT FROM (TRUE, EXCLUDED.task, EXCLUDED.goal, EXCLUDED.start_time, EXCLUDED.end_time)
+        ''', [(email, day['date'], True, day['task'], day['goal'], day['start_time'], day['end_time']) for day in plan])
     cursor.execute('''
-        INSERT INTO goal_plan (email, task_ids)
-        VALUES (%s, %s)
-        ON CONFLICT (email) DO UPDATE
-        SET task_ids = COALESCE(goal_plan.task_ids, '{}'::jsonb) || %s::jsonb
-    ''', (email, json.dumps(task_id_entry), json.dumps(task_id_entry)))
+        UPDATE plan_days SET in_plan = FALSE, task = NULL, goal = NULL, start_time = NULL, end_time = NULL
+        WHERE email = %s AND in_plan AND NOT (date = ANY(%s::date[]))
+    ''', (email, dates))
+    _delete_unused_plan_days(cursor, email)
+    connection.commit()
+
+def _delete_unused_plan_days(cursor, email: str):
+    cursor.execute('DELETE FROM plan_days WHERE email = %s AND NOT in_plan AND task_id IS NULL AND event_id IS NULL', (email,))
 
+def _fetch_synced_ids(cursor, email: str, kind: str) -> dict:
+    cursor.execute(f'SELECT date, {kind}_id, {kind}_hash FROM plan_days WHERE email=%s AND {kind}_id IS NOT NULL', (email,))
+    return {date.strftime('%Y-%m-%d'): {'id': item_id, 'hash': item_hash} for date, item_id, item_hash in cursor.fetchall()}
+
+def _save_synced_ids(cursor, connection, email: str, kind: str, synced_ids: dict):
+    """
+    Stores the synced items of `kind` (task or event) on the rows of their days, and clears them from every other day.
+    """
+    cursor.execute(f'''
+        UPDATE plan_days SET {kind}_id = NULL, {kind}_hash = NULL
+        WHERE email = %s AND {kind}_id IS NOT NULL AND NOT (date = ANY(%s::date[]))
+    ''', (email, list(synced_ids)))
+    if synced_ids:
+        psycopg2.extras.execute_values(cursor, f'''
+            INSERT INTO plan_days (email, date, in_plan, {kind}_id, {kind}_hash) VALUES %s
+            ON CONFLICT (email, date) DO UPDATE SET {kind}_id = EXCLUDED.{kind}_id, {kind}_hash = EXCLUDED.{kind}_hash
+        ''', [(email, date, False, item['id'], item['hash']) for date, item in synced_ids.items()])
+    _delete_unused_plan_days(cursor, email)
     connection.commit()
 
+def fetch_task_ids(cursor, email: str) -> dict:
+    """
+    Returns the google tasks synced for the user, {date: {"id": task id, "hash": content hash}}.
+    """
+    return _fetch_synced_ids(cursor, email, 'task')
+
+def save_task_ids(cursor, connection, email: str, task_ids: dict):
+    """
+    Replaces the google tasks synced for the user.
+
+    args:
+    task_ids: dict mapping dates (YYYY-MM-DD) to {"id": task id, "hash": content hash}.
+    """
+    _save_synced_ids(cursor, connection, email, 'task', task_ids)
+
+def fetch_event_ids(cursor, email: str) -> dict:
+    """
+    Returns the calendar events synced for the user, {date: {"id": event id, "hash": content hash}}.
+    """
+    return _fetch_synced_ids(cursor, email, 'event')
+
+def save_event_ids(cursor, connection, email: str, event_ids: dict):
+    """
+    Replaces the calendar events synced for the user.
+    """
+    _save_synced_ids(cursor, connection, email, 'event', event_ids)
+
 def is_user_present(cursor, email: str) -> bool:
     cursor.execute('SELECT email FROM users WHERE email=%s', (email,))
     return cursor.fetchone() is not None
@@ -97,63 +163,123 @@ def save_user(cursor, connection, email: str, name: str, picture: str):
     cursor.execute('INSERT INTO users (email, name, picture) VALUES (%s, %s, %s) ON CONFLICT (email) DO UPDATE SET name = EXCLUDED.name, picture = EXCLUDED.picture', (email, name, picture))
     connection.commit()
 
-def get_message_count_within_timeframe(cursor, email, timeframe):
+def take_rate_limit_token(cursor, connection, email: str, capacity: float, refill_per_second: float) -> bool:
     """
-    cursor: cursor
-    email: email of user
-    timeframe: duration till which rate_limit will apply to cap messages. This is set to 1 hour by default.
-    
-    returns
-    message_count: integer value of how many messages have been sent by user in the past 1 hour.
+    Refills the user's token bucket for the time elapsed since the last message and takes a token, in one statement.
+    Returns True if a token was available.
     """
-    current_time = datetime.datetime.now(datetime.timezone.utc)
-    timeframe_start = current_time - timeframe
-    cursor.execute(
-        "SELECT COUNT(*) FROM chat_messages WHERE email = %s AND timestamp >= %s AND role = 'user'",
-        (email, timeframe_start)
-    )
-    message_count = cursor.fetchone()[0]
-    return message_count
+    cursor.execute('''
+        INSERT INTO rate_limits AS bucket (email, tokens, updated_at)
+        VALUES (%(email)s, %(capacity)s - 1, CURRENT_TIMESTAMP)
+        ON CONFLICT (email) DO UPDATE
+        SET tokens = LEAST(%(capacity)s, bucket.tokens + EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - bucket.updated_at) * %(refill)s) - 1,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE LEAST(%(capacity)s, bucket.tokens + EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - bucket.updated_at) * %(refill)s) >= 1
+        RETURNING tokens
+    ''', {'email': email, 'capacity': capacity, 'refill': refill_per_second})
+    allowed = cursor.fetchone() is not None
+    connection.commit()
+    return allowed
 
-def save_chat_message(cursor, connection, email: str, role: str, content: str):
-    parts = json.dumps([content])
-    cursor.execute('INSERT INTO chat_messages (email, role, parts) VALUES (%s, %s, %s)', (email, role, parts))
+def get_cached_response(cursor, connection, key: str, ttl_in_secs: float):
+    """
+    Returns the cached response for the key if it is younger than ttl_in_secs, and marks it as recently used. Else returns None.
+    """
+    cursor.execute('''
+        UPDATE response_cache SET last_used_at = CURRENT_TIMESTAMP
+        WHERE key = %s AND created_at > CURRENT_TIMESTAMP - make_interval(secs => %s)
+        RETURNING response
+    ''', (key, ttl_in_secs))
+    result = cursor.fetchone()
     connection.commit()
+    return result[0] if result else None
 
-def get_user_chat_messages(cursor, email: str, timestamp=None):
+def save_cached_response(cursor, connection, key: str, model: str, response, ttl_in_secs: float, max_entries: int):
     """
-    Fetches chat messages after timestamp if timestamp is passed. Else, fetches all messages.
+    Saves the response for the key, then removes expired responses and the least recently used ones beyond max_entries.
     """
-    if timestamp:
-        cursor.execute('SELECT role, parts FROM chat_messages WHERE email=%s AND timestamp > %s ORDER BY id ASC', (email, timestamp))
+    cursor.execute('''
+        INSERT INTO response_cache (key, model, response) VALUES (%s, %s, %s)
+        ON CONFLICT (key) DO UPDATE
+        SET model = EXCLUDED.model, response = EXCLUDED.response, created_at = CURRENT_TIMESTAMP, last_used_at = CURRENT_TIMESTAMP
+    ''', (key, model, psycopg2.extras.Json(response)))
+    cursor.execute('''
+        DELETE FROM response_cache
+        WHERE created_at <= CURRENT_TIMESTAMP - make_interval(secs => %s)
+        OR key IN (SELECT key FROM response_cache ORDER BY last_used_at DESC OFFSET %s)
+    ''', (ttl_in_secs, max_entries))
+    connection.commit()
+
+def save_chat_messages(cursor, connection, rows: list) -> list:
+    """
+    Saves (email, role, content) rows with one multi-row INSERT and one commit.
+
+    returns
+    message_ids: ids of the saved messages, in the order of rows.
+    """
+    values = [(email, role, json.dumps([content])) for email, role, content in rows]
+    # ids come from a serial column, so sorting them gives the insertion order of the VALUES list.
+    returned = psycopg2.extras.execute_values(cursor, 'INSERT INTO chat_messages (email, role, parts) VALUES %s RETURNING id', values, page_size=max(len(values), 1), fetch=True)
+    connection.commit()
+    return sorted(message_id for message_id, in returned)
+
+def get_user_chat_messages(cursor, email: str, timestamp=None, after_id=None):
+    """
+    Fetches chat messages with an id greater than after_id if passed, else after timestamp if passed. Else, fetches all messages.
+    """
+    if after_id:
+        cursor.execute('SELECT id, role, parts FROM chat_messages WHERE email=%s AND id > %s ORDER BY id ASC', (email, after_id))
+    elif timestamp:
+        cursor.execute('SELECT id, role, parts FROM chat_messages WHERE email=%s AND timestamp > %s ORDER BY id ASC', (email, timestamp))
     else:
-        cursor.execute('SELECT role, parts FROM chat_messages WHERE email=%s ORDER BY id ASC', (email,))
-    messages = cursor.fetchall()
+        cursor.execute('SELECT id, role, parts FROM chat_messages WHERE email=%s ORDER BY id ASC', (email,))
+    return _decode_chat_messages(cursor.fetchall())
+
+def get_user_chat_messages_page(cursor, email: str, before_id: int = None, limit: int = 50):
+    """
+    Keyset paginated fetch of the latest `limit` messages older than before_id, or the latest messages if before_id is None.
+    Messages are returned oldest first, the id of the first one is the before_id of the next page.
+    """
+    if before_id:
+        cursor.execute('SELECT id, role, parts FROM chat_messages WHERE email=%s AND id < %s ORDER BY id DESC LIMIT %s', (email, before_id, limit))
+    else:
+        cursor.execute('SELECT id, role, parts FROM chat_messages WHERE email=%s ORDER BY id DESC LIMIT %s', (email, limit))
+    return _decode_chat_messages(reversed(cursor.fetchall()))
+
+def _decode_chat_messages(rows) -> list:
     result = []
-    for role, parts in messages:
+    for message_id, role, parts in rows:
         try:
             parts = json.loads(parts)
         except json.JSONDecodeError:
             logger.error(f"Error decoding JSON for message with role {role} and parts {parts}")
             parts = [parts]
-        result.append({"role": role, "parts": parts})
+        result.append({"id": message_id, "role": role, "parts": parts})
     return result
 
-def save_summary(cursor, conn, email: str, summary: str, timestamp):
-    cursor.execute('INSERT INTO summaries (email, summary, timestamp) VALUES (%s, %s, %s) ON CONFLICT (email) DO UPDATE SET summary = EXCLUDED.summary, timestamp = EXCLUDED.timestamp', (email, summary, timestamp))
+def save_summary(cursor, conn, email: str, summary: str, timestamp, first_message_id: int = None, last_message_id: int = None):
+    """
+    Saves the summary of the chat messages with ids from first_message_id to last_message_id.
+    """
+    cursor.execute('''
+        INSERT INTO summaries (email, summary, timestamp, first_message_id, last_message_id) VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (email) DO UPDATE
+        SET summary = EXCLUDED.summary, timestamp = EXCLUDED.timestamp, first_message_id = EXCLUDED.first_message_id, last_message_id = EXCLUDED.last_message_id
+    ''', (email, summary, timestamp, first_message_id, last_message_id))
     conn.commit()
 
 def get_latest_summary(cursor, email: str):
     """
-    Returns the latest summary along with the timestamp if present, else returns None, None.
+    Returns the latest summary along with the timestamp, and the id of the last message it covers if present, else returns None, None, None.
+    Summaries saved before message ids were recorded have no last message id.
     """
-    cursor.execute('SELECT summary, timestamp FROM summaries WHERE email=%s', (email,))
+    cursor.execute('SELECT summary, timestamp, last_message_id FROM summaries WHERE email=%s', (email,))
     result = cursor.fetchone()
     if result:
         logger.debug(f"get_latest_summary found: {result}")
-        return result[0], result[1] 
+        return result[0], result[1], result[2]
     logger.debug(f"No summary found")
-    return None, None
+    return None, None, None
 
 def delete_chat(cursor, connection, email:str):
     """
@@ -184,10 +310,11 @@ def delete_summaries(cursor, connection, email:str):
 def delete_plan(cursor, connection, email:str):
     """Delete detailed plan for a particular user. Returns True, if suceeded."""
     try:
+        cursor.execute('DELETE FROM plan_days WHERE email = %s', (email,))
         cursor.execute('DELETE FROM goal_plan WHERE email = %s', (email,))
         connection.commit()
         return True
     except Exception as e:
         logger.error(f"Error clearing plan for {email}: {e}")
         connection.rollback()
-        return False
\ No newline at end of file
+        return False
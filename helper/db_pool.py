@@ -0,0 +1,141 @@
+"""Contains a bounded, thread-safe pool of postgres connections shared across sessions"""
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+from logzero import logger
+
+
+class PoolTimeoutError(Exception):
+    """Raised when no connection could be checked out within the configured wait time."""
+
+
+class ConnectionPool:
+    """
+    Wraps psycopg2's ThreadedConnectionPool with checkout/return semantics, health checks and metrics.
+
+    args:
+    dsn: database url used to open new connections.
+    min_connections: connections opened eagerly and kept around.
+    max_connections: upper bound of connections open at any time.
+    timeout: seconds a caller waits for a free connection before PoolTimeoutError is raised.
+    health_check_after: connections idle for longer than this many seconds are pinged before being handed out.
+    """
+    def __init__(self, dsn: str, min_connections: int = 1, max_connections: int = 10, timeout: float = 10.0, health_check_after: float = 30.0):
+        self._pool = psycopg2.pool.ThreadedConnectionPool(min_connections, max_connections, dsn)
+        # ThreadedConnectionPool raises instead of waiting when exhausted, the semaphore makes callers queue up.
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._lock = threading.Lock()
+        self._last_used = {}
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.health_check_after = health_check_after
+        self._in_use = 0
+        self._checkouts = 0
+        self._timeouts = 0
+        self._discarded = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    @contextmanager
+    def connection(self):
+        """
+        Checks out a connection, and returns it to the pool once the block exits.
+        Open transactions are rolled back before the connection is returned.
+        """
+        start = time.monotonic()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self._timeouts += 1
+            raise PoolTimeoutError(f"No database connection available after {self.timeout}s")
+        try:
+            connection = self._checkout()
+        except Exception:
+            self._slots.release()
+            raise
+        self._record_checkout(time.monotonic() - start)
+        try:
+            yield connection
+        finally:
+            self._checkin(connection)
+            self._slots.release()
+
+    def _checkout(self):
+        # Every idle connection might have gone stale (e.g. after a database restart), so retry past the pool size,
+        # the last attempt then gets a newly opened connection, which is checked like the others.
+        for _ in range(self.max_connections + 1):
+            connection = self._pool.getconn()
+            if self._is_healthy(connection):
+                return connection
+            logger.warning("Discarding stale database connection")
+            self._discard(connection)
+        raise psycopg2.OperationalError(f"No healthy database connection after {self.max_connections + 1} attempts")
+
+    def _checkin(self, connection):
+        with self._lock:
+            self._in_use -= 1
+        if connection.closed:
+            self._discard(connection)
+            return
+        try:
+            if connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                connection.rollback()
+        except psycopg2.Error:
+            self._discard(connection)
+            return
+        self._last_used[id(connection)] = time.monotonic()
+        self._pool.putconn(connection)
+
+    def _discard(self, connection):
+        self._last_used.pop(id(connection), None)
+        with self._lock:
+            self._discarded += 1
+        self._pool.putconn(connection, close=True)
+
+    def _is_healthy(self, connection) -> bool:
+        """
+        Closed connections are always unhealthy, connections that sat idle for a while get a cheap round trip.
+        """
+        if connection.closed:
+            return False
+        last_used = self._last_used.get(id(connection))
+        if last_used is not None and time.monotonic() - last_used < self.health_check_after:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _record_checkout(self, waited: float):
+        with self._lock:
+            self._in_use += 1
+            self._checkouts += 1
+            self._total_wait += waited
+            self._max_wait = max(self._max_wait, waited)
+        if waited > 1:
+            logger.warning(f"Waited {waited:.2f}s for a database connection, {self._in_use}/{self.max_connections} in use")
+
+    def stats(self) -> dict:
+        """
+        Returns a snapshot of pool size and wait time metrics.
+        """
+        with self._lock:
+            return {
+                'max_connections': self.max_connections,
+                'in_use': self._in_use,
+                'idle': len(self._pool._pool),
+                'checkouts': self._checkouts,
+                'timeouts': self._timeouts,
+                'discarded': self._discarded,
+                'avg_wait_ms': (self._total_wait / self._checkouts * 1000) if self._checkouts else 0.0,
+                'max_wait_ms': self._max_wait * 1000,
+            }
+
+    def close(self):
+        self._pool.closeall()
@@ -0,0 +1,21 @@
+"""Contains gemini clients bound to an api key, as genai.configure only holds one key per process"""
+import streamlit as st
+from google.ai import generativelanguage as glm
+from google.api_core.client_options import ClientOptions
+
+
+@st.cache_resource(show_spinner=False)
+def get_client(api_key: str) -> glm.GenerativeServiceClient:
+    """
+    Creates the generative service client of an api key once per process, it is shared by every model using the key.
+    """
+    return glm.GenerativeServiceClient(client_options=ClientOptions(api_key=api_key))
+
+
+def bind_client(model, api_key: str):
+    """
+    Makes the model send requests with the api key's client, instead of the client of whichever key
+    genai.configure was last called with. Returns the model.
+    """
+    model._client = get_client(api_key)
+    return model
@@ -0,0 +1,294 @@
+"""Contains functions that read and sync plans from google tasks and calendar in bulk"""
+import datetime
+import hashlib
+import json
+import random
+import time
+
+import httplib2
+from googleapiclient.errors import HttpError
+from logzero import logger
+
+# Google recommends keeping batches of the tasks and calendar apis at 50 requests or fewer.
+BATCH_SIZE = 50
+MAX_RETRIES = 4
+BACKOFF_BASE_IN_SECS = 1
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+# The tasks and calendar apis answer rate limited requests with 403 and one of these reasons instead of 429.
+RETRYABLE_FORBIDDEN_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+# Maximum page size allowed by the tasks api.
+TASKS_PAGE_SIZE = 100
+TASK_FIELDS = 'nextPageToken,items(id,title,due,status,notes,webViewLink)'
+
+
+def _is_retryable(error) -> bool:
+    if not isinstance(error, HttpError):
+        return False
+    if error.resp.status == 403:
+        return not RETRYABLE_FORBIDDEN_REASONS.isdisjoint(_error_reasons(error))
+    return error.resp.status in RETRYABLE_STATUSES
+
+
+def _error_reasons(error: HttpError) -> set:
+    """
+    Returns the reasons listed in the body of an api error, e.g. {'rateLimitExceeded'}.
+    """
+    try:
+        content = error.content.decode('utf-8') if isinstance(error.content, bytes) else error.content
+        details = json.loads(content)['error'].get('errors', [])
+    except (AttributeError, TypeError, ValueError, KeyError):
+        return set()
+    return {detail.get('reason') for detail in details if isinstance(detail, dict)}
+
+
+def _is_gone(error) -> bool:
+    return isinstance(error, HttpError) and error.resp.status in (404, 410)
+
+
+def execute_batched(service, requests: list, batch_size: int = BATCH_SIZE, max_retries: int = MAX_RETRIES, on_progress=None) -> dict:
+    """
+    Executes requests in batch http requests of at most `batch_size` requests each.
+    Requests failing with 429, 5xx or a rate limit 403 are retried with exponential backoff, up to `max_retries` times.
+    A batch failing on the network is recorded as an error of each of its requests, the other batches still run.
+
+    args:
+    service: A Resource object the requests were built from.
+    requests: list of (request_id, HttpRequest) tuples, request_ids must be unique.
+    on_progress: optional callable, called with (completed, total) after every batch.
+    returns
+    results: dict mapping each request_id to a (response, error) tuple, one of which is None.
+    """
+    results = {}
+    completed = 0
+
+    def callback(request_id, response, exception):
+        results[request_id] = (response, exception)
+
+    for start in range(0, len(requests), batch_size):
+        pending = requests[start:start + batch_size]
+        for attempt in range(max_retries + 1):
+            if attempt:
+                delay = BACKOFF_BASE_IN_SECS * 2 ** (attempt - 1) + random.uniform(0, BACKOFF_BASE_IN_SECS)
+                logger.warning(f"Retrying {len(pending)} requests in {delay:.1f}s (attempt {attempt} of {max_retries})")
+                time.sleep(delay)
+            batch = service.new_batch_http_request(callback=callback)
+            for request_id, request in pending:
+                batch.add(request, request_id=request_id)
+            try:
+                batch.execute()
+            except (HttpError, httplib2.HttpLib2Error, OSError) as error:
+                # Transport errors (timeouts, unreachable host) fail the whole batch, they are recorded per request and
+                # not retried, as a create that timed out may have gone through. Results of earlier batches are kept.
+                logger.error(f"Batch request failed: {error!r}")
+                for request_id, _ in pending:
+                    results[request_id] = (None, error)
+            pending = [(request_id, request) for request_id, request in pending if _is_retryable(results.get(request_id, (None, None))[1])]
+            if not pending:
+                break
+        completed += min(batch_size, len(requests) - start)
+        if on_progress:
+            on_progress(completed, len(requests))
+    return results
+
+
+def content_hash(body: dict) -> str:
+    """
+    Returns a stable hash of a request body, used to detect days that changed since the last sync.
+    """
+    return hashlib.sha256(json.dumps(body, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def diff_synced_items(desired: dict, synced: dict):
+    """
+    Compares the bodies that should exist with the items synced previously.
+
+    args:
+    desired: dict mapping dates to request bodies.
+    synced: dict mapping dates to {"id": item id, "hash": content hash of the synced body}.
+    returns
+    inserts, updates, deletes, unchanged: lists of dates.
+    """
+    inserts, updates, unchanged = [], [], []
+    for date, body in desired.items():
+        item = synced.get(date)
+        if not item:
+            inserts.append(date)
+        elif item.get('hash') != content_hash(body):
+            updates.append(date)
+        else:
+            unchanged.append(date)
+    deletes = [date for date in synced if date not in desired]
+    return inserts, updates, deletes, unchanged
+
+
+def sync_items(service, desired: dict, synced: dict, insert, patch, delete, on_progress=None):
+    """
+    Inserts, patches and deletes items so that the synced items match `desired`. Unchanged items cost no requests.
+
+    args:
+    desired, synced: same as diff_synced_items.
+    insert: callable taking a body, returning the HttpRequest that creates the item.
+    patch: callable taking an item id and a body, returning the HttpRequest that updates the item.
+    delete: callable taking an item id, returning the HttpRequest that deletes the item.
+    returns
+    synced_items: items that exist after this sync, in the same format as `synced`.
+    counts: dict with the number of created, updated, unchanged and deleted items.
+    errors: dict mapping dates to the error raised when syncing them.
+    responses: dict mapping dates of created and updated items to the api response.
+    """
+    inserts, updates, deletes, unchanged = diff_synced_items(desired, synced)
+    operations = {}
+    requests = []
+    for date in inserts:
+        operations[date] = 'created'
+        requests.append((date, insert(desired[date])))
+    for date in updates:
+        operations[date] = 'updated'
+        requests.append((date, patch(synced[date]['id'], desired[date])))
+    for date in deletes:
+        operations[date] = 'deleted'
+        requests.append((date, delete(synced[date]['id'])))
+
+    results = execute_batched(service, requests, on_progress=on_progress) if requests else {}
+    synced_items = {date: synced[date] for date in unchanged}
+    counts = {'created': 0, 'updated': 0, 'unchanged': len(unchanged), 'deleted': 0}
+    errors = {}
+    responses = {}
+    for date, operation in operations.items():
+        response, error = results.get(date, (None, None))
+        if error is None:
+            counts[operation] += 1
+            if operation != 'deleted':
+                synced_items[date] = {'id': response['id'], 'hash': content_hash(desired[date])}
+                responses[date] = response
+        elif _is_gone(error):
+            # The item was removed outside the app, it is forgotten so that the next sync re-creates it if needed.
+            if operation == 'deleted':
+                counts['deleted'] += 1
+            else:
+                errors[date] = error
+        else:
+            errors[date] = error
+            if operation != 'created':
+                # Keeping the old hash makes the next sync retry this item.
+                synced_items[date] = synced[date]
+    return synced_items, counts, errors, responses
+
+
+def iter_tasks(service, start_date: str = None, end_date: str = None, page_size: int = TASKS_PAGE_SIZE):
+    """
+    Lazily yields tasks of the user's default tasklist, one page at a time.
+    Filtering by due date happens on the server, and only the fields used by the app are requested.
+
+    args:
+    service: tasks Resource object.
+    start_date: optional YYYY-MM-DD, only tasks due on or after this date are returned.
+    end_date: optional YYYY-MM-DD, only tasks due on or before this date are returned.
+    """
+    filters = {}
+    if start_date:
+        filters['dueMin'] = f"{start_date}T00:00:00Z"
+    if end_date:
+        filters['dueMax'] = f"{end_date}T23:59:59Z"
+    request = service.tasks().list(tasklist='@default', showHidden=True, maxResults=page_size, fields=TASK_FIELDS, **filters)
+    while request is not None:
+        response = request.execute()
+        yield from response.get('items', [])
+        request = service.tasks().list_next(request, response)
+
+
+def _task_body(day: dict, goal_title: str) -> dict:
+    date_obj = datetime.datetime.strptime(day['date'], "%Y-%m-%d").date()
+    time_obj = datetime.datetime.strptime(day['end_time'], "%H:%M:%S").time()
+    task = {
+        'title': goal_title,
+        'due': datetime.datetime.combine(date_obj, time_obj).isoformat() + 'Z',
+    }
+    if day['task']:
+        task['notes'] = day['task']
+    return task
+
+
+def sync_plan_to_tasks(service, plan: list, goal_title: str, synced_tasks: dict):
+    """
+    Brings the user's default tasklist in line with the plan, only sending requests for days that changed since the last sync.
+
+    args:
+    service: tasks Resource object.
+    plan: list of days of the detailed plan.
+    goal_title: title given to every task.
+    synced_tasks: tasks created by the previous sync, {date: {"id": task id, "hash": content hash}}.
+    returns
+    function_result: the counts of created, updated, unchanged and deleted tasks, followed by a dict per
+    created or updated task and an error message per failed day.
+    task_ids: tasks in the tasklist after this sync, in the same format as synced_tasks.
+    """
+    desired = {day['date']: _task_body(day, goal_title) for day in plan}
+    tasks = service.tasks()
+    task_ids, counts, errors, responses = sync_items(
+        service,
+        desired,
+        synced_tasks,
+        insert=lambda body: tasks.insert(tasklist='@default', body=body),
+        patch=lambda task_id, body: tasks.patch(tasklist='@default', task=task_id, body=body),
+        delete=lambda task_id: tasks.delete(tasklist='@default', task=task_id))
+
+    function_result = [counts]
+    for date in sorted(responses):
+        result = responses[date]
+        function_result.append({'title': result['title'],
+                                'due': result['due'],
+                                'status': result['status'],
+                                'notes': result.get('notes', ''),
+                                'web_link': result.get('webViewLink', '')})
+    for date, error in errors.items():
+        logger.debug(f"error when syncing {date}")
+        function_result.append(f'An error occurred while syncing the task for {date}: {error}')
+    logger.debug(f"Tasks sync finished: {counts}")
+    return function_result, task_ids
+
+
+def _calendar_event_body(day: dict, timezone: str) -> dict:
+    start_datetime = datetime.datetime.strptime(f"{day['date']} {day['start_time']}", "%Y-%m-%d %H:%M:%S")
+    end_datetime = datetime.datetime.strptime(f"{day['date']} {day['end_time']}", "%Y-%m-%d %H:%M:%S")
+    return {
+        'summary': day['goal'],
+        'description': day['task'],
+        'start': {
+            'dateTime': start_datetime.isoformat(),
+            'timeZone': timezone,
+        },
+        'end': {
+            'dateTime': end_datetime.isoformat(),
+            'timeZone': timezone,
+        },
+    }
+
+
+def sync_plan_to_calendar(service, plan: list, timezone: str, synced_events: dict, on_progress=None):
+    """
+    Brings the user's primary calendar in line with the plan, only sending requests for days that changed since the last sync.
+
+    args:
+    service: calendar Resource object.
+    plan: list of days of the detailed plan.
+    timezone: timezone of the user.
+    synced_events: events created by the previous sync, {date: {"id": event id, "hash": content hash}}.
+    on_progress: optional callable, called with (completed, total) after every batch.
+    returns
+    event_ids: events in the calendar after this sync, in the same format as synced_events.
+    counts: dict with the number of created, updated, unchanged and deleted events.
+    errors: dict mapping dates to the error raised when syncing their event.
+    """
+    desired = {day['date']: _calendar_event_body(day, timezone) for day in plan}
+    events = service.events()
+    event_ids, counts, errors, _ = sync_items(
+        service,
+        desired,
+        synced_events,
+        insert=lambda body: events.insert(calendarId='primary', body=body),
+        patch=lambda event_id, body: events.patch(calendarId='primary', eventId=event_id, body=body),
+        delete=lambda event_id: events.delete(calendarId='primary', eventId=event_id),
+        on_progress=on_progress)
+    logger.debug(f"Calendar sync finished: {counts}")
+    return event_ids, counts, errors
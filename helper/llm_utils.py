@@ -1,22 +1,36 @@
 """Contains Functions with regards to the gemini model"""
 import copy
 import datetime
-import json
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import streamlit as st
 import google.generativeai as genai 
 from google.protobuf.struct_pb2 import Struct
 from logzero import logger
 
+import helper.context_cache as context_cache
 import helper.database_functions as db_funcs
+import helper.genai_clients as genai_clients
+import helper.plan_context as plan_context
+import helper.plan_stream_parser as plan_stream_parser
+import helper.response_cache as response_cache
+import helper.token_estimator as token_estimator
 import helper.utils as utils
+from helper.conversation import ConversationContext
 
+# Summaries start generating in the background once history reaches this fraction of max_tokens.
+SUMMARY_START_RATIO = 0.8
+# Time waited for pending write-behind saves of summarised messages, so the summary records their ids.
+SUMMARY_IDS_TIMEOUT_IN_SECS = 5
+# Plans are generated in chunks of this many days, and each chunk is retried this many times on malformed JSON.
+PLAN_CHUNK_DAYS = 14
+PLAN_CHUNK_RETRIES = 2
+PLAN_FIELDS = ("date", "task", "goal", "start_time", "end_time")
 
-def initialise_model_setup():
-    """
-    Initializes resources that are required by the gen ai (gemini) model gemini. 
-    """
-    genai.configure(api_key=st.session_state["gemini_api_key"])
-    system_behavior = """ 
+# System instructions are module level, so they can be part of response cache keys.
+CHAT_SYSTEM_INSTRUCTION = """ 
                 You are a Smart Assistant designed to help users break down tasks and manage their goals using the SMART framework. You also have the ability to interact with external applications like Google Tasks through function calls.
 
                 1. Assess if the user has given a goal and supporting details adhering to the SMART framework, along with a start and end date for the goal.
@@ -28,20 +42,21 @@ def initialise_model_setup():
                     i. if the plan is present call the function directly. **DO NOT PROMPT FOR ADDITIONAL DETAILS FOR FUNCTION CALLING**.
                     ii. If the plan is missing, inform the user to generate the plan 1st. **DO NOT PROMPT FOR ADDITIONAL DETAILS FOR FUNCTION CALLING**.
                 b. If the user requests for feedback on progress/fetch tasks, call the function `fetch_tasks_from_google_tasks`.
-                    i. if the tasks are synced to google call the function directly use the date parameter if mentioned, else set date to None. **DO NOT PROMPT FOR ADDITIONAL DETAILS FOR FUNCTION CALLING**.
+                    i. if the tasks are synced to google call the function directly use the due_date parameter if a single date is mentioned, or start_date and end_date for a range of dates, else set the dates to None. **DO NOT PROMPT FOR ADDITIONAL DETAILS FOR FUNCTION CALLING**.
                     ii. If the tasks are not synced to google, inform the user to sync the tasks to google before attempting this. **DO NOT PROMPT FOR ADDITIONAL DETAILS FOR FUNCTION CALLING**
 
                 4. If a function call returns an error or unexpected result, with a clear and helpful message, suggest possible next steps or alternatives.
                 5. If a plan is provided but 'key=detailed_plan' isn't present in the prompt, let the user know they can generate a detailed plan.
                 6. if 'key=detailed_plan' is present in the prompt, let the user know they can Sync the tasks to google tasks.
+                    i. The prompt only lists the days of the plan around today, call the function `get_plan_days` with start_date and end_date to look up any other days. **DO NOT PROMPT FOR ADDITIONAL DETAILS FOR FUNCTION CALLING**.
                 7. 'key=Not_Synced' indicates Tasks are not synced to Google tasks. 
                 8. 'key=TasksSynced' in prompt indicates Tasks are synced to Google Tasks.
                 9. 'key=No_plan' indicates no detailed plan is present. 
                 10. Only calendar events can be synced and generated using the 'Send plan to calendar' button, this can be suggested only after 'key=detailed_plan' is present in the prompt.
                 11. If a question is irrelevant to Goal setting and task breakdowns, politely respond, "Sorry, I can't help with this request.".
                 """
-    
-    json_system_behavior = """
+
+PLAN_SYSTEM_INSTRUCTION = """
                 You are a Smart Assistant designed to generate a plan for users based on the SMART framework for goals, using the context of messages provided.
                 1. Do not leave out any details in the messages.
                 2. Use the exact details as provided in the chat between the user and model.
@@ -51,85 +66,438 @@ def initialise_model_setup():
                 6. When generating a plan, provide the output in the following JSON format:
                    {"plan": [{"date": "YYYY-MM-DD", "task": "Detailed Task description", "goal": "Goal description", "start_time":"start time duration", "end_time": "end time duration"}, ...]}
                 """
-    
-    summary_behavior = """
+
+SUMMARY_SYSTEM_INSTRUCTION = """
                 You're a smart assistant that provides a summary of the conversation between the user, and model. 
                 1. Provide summary, while keeping the contextual details, and quantitaive details in place. 
                 2. Try to provide a summary under 500 words. Try not exceeding the limit.  
                 """
+
+
+def _model_specs() -> dict:
+    """
+    Returns the arguments of genai.GenerativeModel for the summary, chat and plan models.
+    """
     generation_config_summary = genai.GenerationConfig(temperature=0.25)
     generation_config_assistant = genai.GenerationConfig(temperature=0.25)
     generation_config_json = genai.GenerationConfig(temperature=0.3, response_mime_type="application/json")
     
     functions = {
         "fetch_tasks": utils.fetch_tasks_from_google_tasks,
-        "add_or_update_task": utils.add_or_update_task_to_google_tasks
+        "add_or_update_task": utils.add_or_update_task_to_google_tasks,
+        "get_plan_days": utils.get_plan_days
     }
-    st.session_state['summary_model'] = genai.GenerativeModel('gemini-1.5-flash', system_instruction=summary_behavior, generation_config=generation_config_summary)
-    st.session_state['chat_model'] = genai.GenerativeModel('gemini-1.5-flash', system_instruction=system_behavior, generation_config=generation_config_assistant, tools=functions.values())
-    st.session_state['plan_model']  = genai.GenerativeModel('gemini-1.5-flash', system_instruction=json_system_behavior, generation_config=generation_config_json)
+    return {
+        'summary': dict(model_name='gemini-1.5-flash', system_instruction=SUMMARY_SYSTEM_INSTRUCTION, generation_config=generation_config_summary),
+        'chat': dict(model_name='gemini-1.5-flash', system_instruction=CHAT_SYSTEM_INSTRUCTION, generation_config=generation_config_assistant, tools=list(functions.values())),
+        'plan': dict(model_name='gemini-1.5-flash', system_instruction=PLAN_SYSTEM_INSTRUCTION, generation_config=generation_config_json),
+    }
+
+class ModelRegistry:
+    """
+    Builds the summary, chat and plan models of an api key on first use, and keeps them for every session using that key.
+    Specs, generation configs and tool declarations are derived once, when the first model is built.
+    Every model is bound to the key's own client, so sessions using other keys can't change the key it sends.
+
+    args:
+    api_key: gemini api key the models are used with.
+    """
+    def __init__(self, api_key: str):
+        self.api_key = api_key
+        self._specs = None
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def spec(self, name: str) -> dict:
+        with self._lock:
+            if self._specs is None:
+                self._specs = _model_specs()
+            return self._specs[name]
+
+    def get(self, name: str) -> genai.GenerativeModel:
+        model = self._models.get(name)
+        if model is None:
+            spec = self.spec(name)
+            with self._lock:
+                model = self._models.get(name)
+                if model is None:
+                    model = self._models[name] = genai_clients.bind_client(genai.GenerativeModel(**spec), self.api_key)
+                    logger.info(f"Built the {name} model")
+        return model
+
+@st.cache_resource(show_spinner=False)
+def get_model_registry(api_key: str) -> ModelRegistry:
+    """
+    Creates the model registry once per process and api key.
+    """
+    return ModelRegistry(api_key)
+
+def get_model(name: str) -> genai.GenerativeModel:
+    """
+    Returns the session's 'summary', 'chat' or 'plan' model, built on first use.
+    """
+    return get_model_registry(st.session_state["gemini_api_key"]).get(name)
     
-def generate_plan_response(prompt:str, model:genai.GenerativeModel, db=None, cursor=None):
-    messages = copy.deepcopy(st.session_state['messages'])
-    messages.append({"role":"user", "parts": [prompt]})
-    response = generate_response(messages, model, db=db, cursor=cursor)
-    if not response.candidates:
-        st.error("No response generated. Please try again.")
-        return None
-    response_text = response.candidates[0].content.parts[0].text
-    return response_text
-
-def parse_plan_response(response_text:str):
+class PlanChunkError(Exception):
+    """Raised when a chunk of the plan could not be generated after all retries."""
+
+def generate_plan(model:genai.GenerativeModel, start_date:datetime.date, end_date:datetime.date, start_time:datetime.time, end_time:datetime.time, chunk_days:int = PLAN_CHUNK_DAYS, on_days=None) -> tuple:
+    """
+    Generates the detailed plan from start_date to end_date. Long ranges are split into chunks of `chunk_days`,
+    which are generated concurrently with the same conversation context and merged into one plan.
+    Responses are streamed, every day is validated as soon as it is complete.
+    Chunks requested before with the same history, dates and times are served from the response cache.
+    Raises ValueError if start_date is after end_date.
+
+    args:
+    on_days: optional callable, called on this thread with each batch of newly completed days, in no particular order.
+
+    returns
+    plan: list of days ordered by date, days of chunks that failed are left out.
+    failed_chunks: (chunk_start, chunk_end) of every chunk that could not be generated or is missing days,
+    the plan should not replace a saved one unless this is empty.
+    """
+    if start_date > end_date:
+        raise ValueError(f"Start date {start_date} is after end date {end_date}")
+    chunks = _split_date_range(start_date, end_date, chunk_days)
+    cache = response_cache.get_response_cache()
+    prompts = [_plan_prompt(chunk_start, chunk_end, start_date, end_date, start_time, end_time) for chunk_start, chunk_end in chunks]
+    keys = [_plan_cache_key(model, prompt, chunk_start, chunk_end, start_time, end_time)
+            for (chunk_start, chunk_end), prompt in zip(chunks, prompts)]
+    cached_days = [cache.get(model.model_name, key) for key in keys]
+    missed = [index for index, days in enumerate(cached_days) if days is None]
+    # Messages are built here, the executor's threads can't read st.session_state.
+    # History is only built if a chunk missed the cache, and only once, so summary scheduling and calibration
+    # run at most once per plan.
+    requests = {}
+    if missed:
+        history = _build_history(st.session_state['messages'], model, prompt=max((prompts[index] for index in missed), key=len))
+        for index in missed:
+            requests[index] = _apply_context_cache('plan', model, _add_prompt(history, prompts[index]))
+    start = time.perf_counter()
+    executor = get_plan_executor()
+    days_queue = queue.Queue()
+    futures = {index: executor.submit(_generate_plan_chunk, chunk_model, messages, *chunks[index], days_queue)
+               for index, (chunk_model, messages) in requests.items()}
+    if on_days and len(futures) < len(chunks):
+        on_days([day for days in cached_days if days is not None for day in days])
+    while not all(future.done() for future in futures.values()) or not days_queue.empty():
+        new_days = _drain_queue(days_queue, timeout=0.2)
+        if new_days and on_days:
+            on_days(new_days)
+    plan = []
+    failed_chunks = []
+    for index, (chunk_start, chunk_end) in enumerate(chunks):
+        if cached_days[index] is not None:
+            plan.extend(cached_days[index])
+            continue
+        try:
+            days = futures[index].result()
+        except PlanChunkError:
+            logger.error(f"Plan from {chunk_start} to {chunk_end} could not be generated", exc_info=True)
+            failed_chunks.append((chunk_start, chunk_end))
+            continue
+        plan.extend(days)
+        # Truncated chunks aren't cached, so asking again gives the model another chance to complete them.
+        if len({day['date'] for day in days}) == (chunk_end - chunk_start).days + 1:
+            cache.put(model.model_name, keys[index], days)
+        else:
+            logger.error(f"Plan from {chunk_start} to {chunk_end} is missing days")
+            failed_chunks.append((chunk_start, chunk_end))
+    logger.info(f"Plan of {len(chunks)} chunks generated in {time.perf_counter() - start:.2f}s, {len(chunks) - len(futures)} served from cache, {len(failed_chunks)} failed")
+    return _merge_plan_chunks(plan, start_date, end_date), failed_chunks
+
+@st.cache_resource(show_spinner=False)
+def get_plan_executor() -> ThreadPoolExecutor:
+    """
+    Thread pool shared by every session, on which chunks of plans are generated concurrently.
+    """
+    return ThreadPoolExecutor(max_workers=st.secrets.get('plan_workers', 4), thread_name_prefix='plan')
+
+def _split_date_range(start_date:datetime.date, end_date:datetime.date, chunk_days:int) -> list:
+    """
+    Returns (chunk_start, chunk_end) tuples covering start_date to end_date, both included.
+    """
+    chunks = []
+    chunk_start = start_date
+    while chunk_start <= end_date:
+        chunk_end = min(end_date, chunk_start + datetime.timedelta(days=chunk_days - 1))
+        chunks.append((chunk_start, chunk_end))
+        chunk_start = chunk_end + datetime.timedelta(days=1)
+    return chunks
+
+def _plan_prompt(chunk_start, chunk_end, start_date, end_date, start_time, end_time) -> str:
+    prompt = f"Using the previous messages as context. Generate a detailed plan starting from date {chunk_start} to {chunk_end} scheduled each day from start_time {start_time} to {end_time}"
+    if (chunk_start, chunk_end) != (start_date, end_date):
+        prompt += f". These dates are one part of the whole plan running from {start_date} to {end_date}, the tasks must fit where these dates fall in the whole plan"
+    return prompt
+
+def _plan_cache_key(model:genai.GenerativeModel, prompt:str, chunk_start, chunk_end, start_time, end_time) -> str:
+    """
+    Returns the response cache key of a plan chunk. The conditional metadata appended to the request is left out,
+    the current plan and sync status it holds don't change the plan that is asked for.
+    """
+    messages = st.session_state['messages'].messages() + [{"role": "user", "parts": [prompt]}]
+    if st.session_state['latest_summary']:
+        messages.insert(0, {"role": "model", "parts": [st.session_state['latest_summary']]})
+    params = {'start_date': chunk_start, 'end_date': chunk_end, 'start_time': start_time, 'end_time': end_time}
+    return response_cache.response_key(model.model_name, PLAN_SYSTEM_INSTRUCTION, messages, params)
+
+def _drain_queue(days_queue:queue.Queue, timeout:float) -> list:
+    """
+    Waits up to `timeout` seconds for a day, then returns it along with every other day already queued.
+    """
     try:
-        response_json = json.loads(response_text)
-        return response_json.get("plan", [])
-    except json.JSONDecodeError as e:
-        st.error("Failed to decode the response. Please try again.")
-        logger.error("Failed to decode the response. Please try again.", exc_info=True)
+        days = [days_queue.get(timeout=timeout)]
+    except queue.Empty:
         return []
-    
-def generate_response(messages:list, model:genai.GenerativeModel, max_tokens = 5000, db=None, cursor=None):
+    while True:
+        try:
+            days.append(days_queue.get_nowait())
+        except queue.Empty:
+            return days
+
+def _generate_plan_chunk(model:genai.GenerativeModel, messages:list, chunk_start:datetime.date, chunk_end:datetime.date, days_queue:queue.Queue = None, retries:int = PLAN_CHUNK_RETRIES) -> list:
+    """
+    Runs on the plan executor, so it must not touch st.session_state.
+    Streams the response, and puts every valid day on `days_queue` as soon as it is parsed.
+    A truncated response keeps the days parsed before the cut, the chunk is only generated again,
+    up to `retries` times, if no valid day was parsed at all. Any failure of the last attempt is raised as PlanChunkError.
+    """
+    last_error = None
+    for attempt in range(retries + 1):
+        days = []
+        try:
+            response = model.generate_content(messages, stream=True)
+            for day in plan_stream_parser.iter_plan_days(_iter_text(response)):
+                if not _validate_plan_days([day], chunk_start, chunk_end):
+                    continue
+                days.append(day)
+                if days_queue is not None:
+                    days_queue.put(day)
+        except Exception as error:
+            last_error = error
+            logger.warning(f"Plan from {chunk_start} to {chunk_end} failed to stream, attempt {attempt + 1}", exc_info=True)
+        if days:
+            return days
+        logger.warning(f"No valid days in the plan from {chunk_start} to {chunk_end}, attempt {attempt + 1}")
+    raise PlanChunkError(f"No valid plan from {chunk_start} to {chunk_end} after {retries + 1} attempts") from last_error
+
+def _validate_plan_days(days:list, start_date:datetime.date, end_date:datetime.date) -> list:
+    """
+    Keeps the days that have every field of the plan format and a date within start_date and end_date.
+    """
+    valid_days = []
+    for day in days:
+        if not isinstance(day, dict) or not all(key in day for key in PLAN_FIELDS):
+            continue
+        try:
+            date = datetime.datetime.strptime(day['date'], "%Y-%m-%d").date()
+        except (TypeError, ValueError):
+            continue
+        if start_date <= date <= end_date:
+            valid_days.append(day)
+    return valid_days
+
+def _merge_plan_chunks(days:list, start_date:datetime.date, end_date:datetime.date) -> list:
+    """
+    Orders the days of all chunks by date, keeping the first day generated for every date.
+    """
+    plan = {}
+    for day in days:
+        plan.setdefault(day['date'], day)
+    missing_days = (end_date - start_date).days + 1 - len(plan)
+    if missing_days > 0:
+        logger.warning(f"Generated plan is missing {missing_days} days")
+    return [plan[date] for date in sorted(plan)]
+
+def generate_response(context:ConversationContext, model:genai.GenerativeModel, max_tokens = 5000, stream=False, prompt:str=None, spec_name:str='chat'):
     """
     Uses gemini api to generate a response based on input. 
     args:
-    messages: List of message objects for the conversation history.
+    context: ConversationContext holding the conversation history, older messages are summarised in the background as max_tokens is approached.
     model: Generative Model to be used for the task. default = genai.GenerativeModel('gemini-1.5-flash').
+    stream: if True, returns a generator of text chunks that can be passed to st.write_stream, instead of the response.
+    prompt: optional one-off user prompt sent after the history, without being added to it.
+    spec_name: name of the model in the registry, used to build it on top of a cached context.
     """
-    token_count = model.count_tokens(messages).total_tokens
-    logger.debug(f"token count: {token_count}")
-    summary = st.session_state['latest_summary']
-    if token_count < max_tokens:
-        if summary:
-            logger.debug(f"Latest summary is fetched with newer messages")
-            messages = [{"role": "model", "parts": summary}] + messages
-    else:
-        logger.debug("Summarizing older messages to reduce token count.")
-        with st.spinner("New Summary is being generated..."):
-            summary = summarize_history(messages[-15:-5])
-        timestamp = datetime.datetime.now()
-        db_funcs.save_summary(cursor, db, st.session_state['user_info']['email'], summary, timestamp)
-        utils.cached_get_latest_summary.clear()
-        st.session_state['latest_summary'] = summary
-        messages = [{"role": "model", "parts": [summary]}] + messages[-5:]
-        st.session_state['messages'] = messages[-5:]
-    messages = copy.deepcopy(messages)
-    _append_conditional_messages(messages)
+    messages = _build_request_messages(context, model, max_tokens, prompt)
+    model, messages = _apply_context_cache(spec_name, model, messages)
+    if stream:
+        return _stream_response(messages, model)
+
+    start = time.perf_counter()
     response = model.generate_content(messages)
     candidate = response.candidates[0]
     logger.debug(f"candidate is -> {candidate}")
 
-    function_call = None
-    for part in candidate.content.parts:
-        if hasattr(part, 'function_call'):
-            function_call = part.function_call
-            break
-
-    final_reponse = _handle_llm_function_call(messages, response, function_call)
+    function_call = _get_function_call(candidate)
+    final_reponse = _handle_llm_function_call(messages, response, function_call, model=model)
+    logger.info(f"Response generated in {time.perf_counter() - start:.2f}s")
     if final_reponse:
         return final_reponse
     
     return response
 
+def _build_request_messages(context:ConversationContext, model:genai.GenerativeModel, max_tokens = 5000, prompt:str=None) -> list:
+    """
+    Returns the messages sent to the model: the latest summary, the conversation history and the optional prompt,
+    with the conditional metadata appended to the last message. Starts a background summary once history nears max_tokens.
+    """
+    return _add_prompt(_build_history(context, model, max_tokens, prompt), prompt)
+
+def _build_history(context:ConversationContext, model:genai.GenerativeModel, max_tokens = 5000, prompt:str=None) -> list:
+    """
+    Returns the latest summary followed by the conversation history. Swaps in a finished summary,
+    and starts a background summary once history and prompt near max_tokens.
+    """
+    _swap_in_finished_summary(context)
+    extra_messages = [{"role": "user", "parts": [prompt]}] if prompt else []
+    estimator = token_estimator.get_token_estimator()
+    token_count = context.total_tokens + estimator.estimate(extra_messages)
+    estimator.maybe_calibrate(model, context)
+    logger.debug(f"estimated token count: {token_count}")
+    if token_count >= max_tokens * SUMMARY_START_RATIO:
+        _schedule_summary(context)
+    summary = st.session_state['latest_summary']
+    messages = context.messages()
+    if summary:
+        logger.debug(f"Latest summary is fetched with newer messages")
+        messages.insert(0, {"role": "model", "parts": [summary]})
+    return messages
+
+def _add_prompt(history:list, prompt:str=None) -> list:
+    """
+    Returns a copy of history with the optional prompt, and the conditional metadata appended to the last message.
+    """
+    messages = history + ([{"role": "user", "parts": [prompt]}] if prompt else [])
+    # Only the last message is modified, so only that one is copied.
+    messages[-1] = copy.deepcopy(messages[-1])
+    _append_conditional_messages(messages)
+    return messages
+
+def _apply_context_cache(spec_name:str, model:genai.GenerativeModel, messages:list):
+    """
+    Returns the model and messages to send. With the context cache enabled, the system instruction and the summary
+    at the head of messages are held by a cached context and referred to by handle, instead of being sent every time.
+    """
+    cache = context_cache.get_context_cache()
+    if cache is None:
+        return model, messages
+    prefix = messages[:1] if st.session_state['latest_summary'] and len(messages) > 1 else []
+    registry = get_model_registry(st.session_state['gemini_api_key'])
+    cached_model = cache.model_for(spec_name, registry.spec(spec_name), prefix, registry.api_key)
+    if cached_model is None:
+        return model, messages
+    return cached_model, messages[len(prefix):]
+
+def _stream_response(messages:list, model:genai.GenerativeModel):
+    """
+    Yields the text of the response as chunks arrive. If the model asks for a function call,
+    the call is handled and the text of the follow up response is streamed instead.
+    """
+    start = time.perf_counter()
+    first_chunk_latency = None
+    response = model.generate_content(messages, stream=True)
+    for chunk in response:
+        if not chunk.candidates:
+            continue
+        candidate = chunk.candidates[0]
+        function_call = _get_function_call(candidate)
+        if function_call:
+            # The remaining chunks have to be consumed, so the model's turn holds the complete function call.
+            response.resolve()
+            chunks = _handle_llm_function_call(messages, response, function_call, stream=True, model=model)
+        else:
+            chunks = [chunk]
+        for text in _iter_text(chunks):
+            if first_chunk_latency is None:
+                first_chunk_latency = time.perf_counter() - start
+            yield text
+        if function_call:
+            break
+    logger.info(f"Streamed response, time to first token: {first_chunk_latency or 0:.2f}s, total: {time.perf_counter() - start:.2f}s")
+
+def _iter_text(chunks):
+    """
+    Yields the text parts of streamed chunks, skipping parts that hold no text, e.g. function calls.
+    """
+    for chunk in chunks:
+        if not chunk.candidates:
+            continue
+        for part in chunk.candidates[0].content.parts:
+            if part.text:
+                yield part.text
+
+def _get_function_call(candidate):
+    """
+    Returns the first function call present in the candidate's parts, else None.
+    """
+    for part in candidate.content.parts:
+        if part.function_call:
+            return part.function_call
+    return None
+
+@st.cache_resource(show_spinner=False)
+def get_summary_executor() -> ThreadPoolExecutor:
+    """
+    Thread pool shared by every session, on which summaries are generated off the request path.
+    """
+    return ThreadPoolExecutor(max_workers=st.secrets.get('summary_workers', 2), thread_name_prefix='summary')
+
+def _schedule_summary(context:ConversationContext, keep_last:int = 5):
+    """
+    Starts summarising all but the latest `keep_last` messages in the background, unless a summary is already pending.
+    The messages are only evicted from the context once the summary is swapped in.
+    """
+    if st.session_state.get('pending_summary'):
+        return
+    covered = len(context) - keep_last
+    if covered <= 0:
+        return
+    logger.debug("Summarizing older messages in the background to reduce token count.")
+    messages = context.messages()[:covered][-10:]
+    if st.session_state['latest_summary']:
+        # Carries the context of the previous summary over into the new one.
+        messages = [{"role": "model", "parts": [st.session_state['latest_summary']]}] + messages
+    covered_ids = context.oldest_ids(covered)
+    # The summary model is passed in, the executor's threads can't read st.session_state.
+    future = get_summary_executor().submit(summarize_history, messages, get_model('summary'))
+    st.session_state['pending_summary'] = {
+        'future': future,
+        'covered': covered,
+        'generation': context.generation,
+        'timestamp': datetime.datetime.now(),
+        # Ids of write-behind saves may still be pending, they are resolved when the summary is saved.
+        'message_ids': covered_ids,
+    }
+
+def _swap_in_finished_summary(context:ConversationContext):
+    """
+    Replaces the summarised messages with the new summary, if the background summary has finished, and saves it.
+    The summary is only saved here, so a summary of a history that was cleared or reset meanwhile is never written back.
+    """
+    pending = st.session_state.get('pending_summary')
+    if not pending or not pending['future'].done():
+        return
+    st.session_state['pending_summary'] = None
+    if pending['generation'] != context.generation:
+        logger.debug("Discarding summary of a conversation that has since been cleared")
+        return
+    try:
+        summary = pending['future'].result()
+    except Exception:
+        logger.error("Background summary failed", exc_info=True)
+        return
+    message_ids = ConversationContext.resolve_ids(pending['message_ids'], timeout=SUMMARY_IDS_TIMEOUT_IN_SECS)
+    with db_funcs.get_connection() as (connection, cursor):
+        db_funcs.save_summary(cursor, connection, st.session_state['user_info']['email'], summary, pending['timestamp'],
+                              message_ids[0] if message_ids else None, message_ids[-1] if message_ids else None)
+    logger.info(f"Summary generated in the background for {st.session_state['user_info']['email']}")
+    context.evict_oldest(pending['covered'])
+    st.session_state['latest_summary'] = summary
+    utils.cached_get_latest_summary.clear()
+
 def _append_conditional_messages(messages):
     """
     appends extra metadata to the user's response, if appropriate conditions are fulfilled.
@@ -140,7 +508,9 @@ def _append_conditional_messages(messages):
         messages[-1]['parts'][0] += f"""\t start_time:{st.session_state['start_time'].strftime('%H-%M-%S')}, end_time:{st.session_state['end_time'].strftime('%H-%M-%S')}"""
 
     if st.session_state['plan']:
-        messages[-1]['parts'][0] += f"\n 'key=detailed_plan' Plan = {st.session_state['plan']}"
+        encoded_plan = plan_context.encode_plan(st.session_state['plan'], max_tokens=st.secrets.get('plan_context_max_tokens', 1000))
+        logger.debug(f"Plan context uses about {token_estimator.get_token_estimator().estimate_message({'parts': [encoded_plan]})} tokens")
+        messages[-1]['parts'][0] += f"\n 'key=detailed_plan' Plan = {encoded_plan}"
     else:
         messages[-1]['parts'][0] += f"\n 'key=No_plan'. No plans"
         
@@ -150,9 +520,10 @@ def _append_conditional_messages(messages):
     if st.session_state['task_ids_generated']:
         messages[-1]['parts'][0] += f"\n 'key=TasksSynced' are synced to Google Tasks"
     
-def _handle_llm_function_call(messages, response, function_call = None):
+def _handle_llm_function_call(messages, response, function_call = None, stream=False, model:genai.GenerativeModel = None):
     """
     Handles function calls if content.parts contains it.
+    If stream is True, the follow up response is requested as a stream, from `model` which defaults to the session's chat model.
     """
     if function_call:
         logger.debug(f'response for function call: {function_call}')
@@ -164,12 +535,16 @@ def _handle_llm_function_call(messages, response, function_call = None):
         if function_name == "fetch_tasks_from_google_tasks":
             if st.session_state['task_ids_generated']:
                 due_date = function_args_dict.get('due_date', None)
-                logger.debug(f'parsed date = {due_date}')
-                function_result.append(utils.fetch_tasks_from_google_tasks(due_date))
+                start_date = function_args_dict.get('start_date', None)
+                end_date = function_args_dict.get('end_date', None)
+                logger.debug(f'parsed date = {due_date}, range = {start_date} to {end_date}')
+                function_result.append(utils.fetch_tasks_from_google_tasks(due_date, start_date, end_date))
             else:
                 function_result.append("No tasks are synced to google, please generate a plan by clicking the 'generate and view plan' and then try again")
         elif function_name == "add_or_update_task_to_google_tasks":
             function_result.append(utils.add_or_update_task_to_google_tasks())       
+        elif function_name == "get_plan_days":
+            function_result.append(utils.get_plan_days(function_args_dict.get('start_date'), function_args_dict.get('end_date', None)))
         else:
             logger.debug("Unknown function being hit")
             function_result.append({"error": "Unknown function"})
@@ -189,19 +564,20 @@ def _handle_llm_function_call(messages, response, function_call = None):
             },
         ]
         messages.extend(new_messages)
-        final_response = st.session_state['chat_model'].generate_content(messages)
+        final_response = (model or get_model('chat')).generate_content(messages, stream=stream)
         logger.debug(f"final response = {final_response}")
         return final_response
     return None
 
-def summarize_history(messages:list):
+def summarize_history(messages:list, model:genai.GenerativeModel = None):
     """
     Summarizes the given messages to reduce token count, while maintaining context.
 
     args:
     messages: List of message objects to summarize
+    model: Generative Model used to summarize, defaults to the session's summary model.
     """
-    model = st.session_state['summary_model']
+    model = model or get_model('summary')
     summary_prompt = "Summarize the following conversation, while maintaing qunatitative specific details :\n"
     for message in messages:
         if message["role"] == "user":
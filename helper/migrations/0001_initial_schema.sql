@@ -0,0 +1,30 @@
+-- Tables that used to be created by initialize_database() on every connection.
+CREATE TABLE IF NOT EXISTS users (
+    email TEXT PRIMARY KEY,
+    name TEXT,
+    picture TEXT
+);
+
+CREATE TABLE IF NOT EXISTS goal_plan (
+    email TEXT PRIMARY KEY,
+    plan JSONB,
+    task_ids JSONB,
+    FOREIGN KEY(email) REFERENCES users(email)
+);
+
+CREATE TABLE IF NOT EXISTS chat_messages (
+    id SERIAL PRIMARY KEY,
+    email TEXT,
+    role TEXT,
+    parts TEXT,
+    timestamp TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY(email) REFERENCES users(email)
+);
+
+CREATE TABLE IF NOT EXISTS summaries (
+    id SERIAL PRIMARY KEY,
+    email TEXT,
+    summary TEXT,
+    timestamp TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY(email) REFERENCES users(email)
+);
@@ -0,0 +1,7 @@
+-- save_summary upserts with ON CONFLICT (email), which needs a unique index on summaries.email.
+-- Keep only the latest summary per user before adding it.
+DELETE FROM summaries older
+USING summaries newer
+WHERE older.email = newer.email AND older.id < newer.id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS summaries_email_key ON summaries (email);
@@ -0,0 +1,9 @@
+-- Indexes for the hot chat_messages queries, which otherwise sequentially scan the whole table.
+-- get_message_count_within_timeframe: partial index, the count can be answered with an index only scan.
+CREATE INDEX IF NOT EXISTS chat_messages_user_email_timestamp_idx ON chat_messages (email, timestamp) WHERE role = 'user';
+
+-- get_user_chat_messages with a timestamp: filters on email and timestamp.
+CREATE INDEX IF NOT EXISTS chat_messages_email_timestamp_idx ON chat_messages (email, timestamp);
+
+-- get_user_chat_messages without a timestamp: filters on email and returns rows ordered by id.
+CREATE INDEX IF NOT EXISTS chat_messages_email_id_idx ON chat_messages (email, id);
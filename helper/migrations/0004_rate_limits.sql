@@ -0,0 +1,6 @@
+-- Token buckets used by the postgres rate limiter backend, one row per user.
+CREATE TABLE IF NOT EXISTS rate_limits (
+    email TEXT PRIMARY KEY,
+    tokens DOUBLE PRECISION NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,2 @@
+-- Calendar events created for each day of the plan, {"YYYY-MM-DD": {"id": event id, "hash": content hash}}.
+ALTER TABLE goal_plan ADD COLUMN IF NOT EXISTS event_ids JSONB;
@@ -0,0 +1,36 @@
+-- One row per day of a user's plan, along with the google task and calendar event synced for it.
+-- Rows of days removed from the plan are kept (in_plan = FALSE) until their task and event are deleted by a sync.
+-- goal_plan.plan, task_ids and event_ids are no longer written, they are only read here to backfill.
+CREATE TABLE IF NOT EXISTS plan_days (
+    email TEXT NOT NULL REFERENCES users(email),
+    date DATE NOT NULL,
+    in_plan BOOLEAN NOT NULL DEFAULT TRUE,
+    task TEXT,
+    goal TEXT,
+    start_time TEXT,
+    end_time TEXT,
+    task_id TEXT,
+    task_hash TEXT,
+    event_id TEXT,
+    event_hash TEXT,
+    PRIMARY KEY (email, date)
+);
+
+INSERT INTO plan_days (email, date, task, goal, start_time, end_time)
+SELECT goal_plan.email, (day->>'date')::date, day->>'task', day->>'goal', day->>'start_time', day->>'end_time'
+FROM goal_plan, jsonb_array_elements(goal_plan.plan) AS day
+WHERE jsonb_typeof(goal_plan.plan) = 'array' AND day->>'date' ~ '^\d{4}-\d{2}-\d{2}$'
+ON CONFLICT (email, date) DO NOTHING;
+
+-- task_ids holds either bare ids or {"id", "hash"} objects, depending on when the tasks were synced.
+INSERT INTO plan_days (email, date, in_plan, task_id, task_hash)
+SELECT goal_plan.email, synced.key::date, FALSE, COALESCE(synced.value->>'id', synced.value #>> '{}'), synced.value->>'hash'
+FROM goal_plan, jsonb_each(goal_plan.task_ids) AS synced
+WHERE jsonb_typeof(goal_plan.task_ids) = 'object' AND synced.key ~ '^\d{4}-\d{2}-\d{2}$'
+ON CONFLICT (email, date) DO UPDATE SET task_id = EXCLUDED.task_id, task_hash = EXCLUDED.task_hash;
+
+INSERT INTO plan_days (email, date, in_plan, event_id, event_hash)
+SELECT goal_plan.email, synced.key::date, FALSE, synced.value->>'id', synced.value->>'hash'
+FROM goal_plan, jsonb_each(goal_plan.event_ids) AS synced
+WHERE jsonb_typeof(goal_plan.event_ids) = 'object' AND synced.key ~ '^\d{4}-\d{2}-\d{2}$'
+ON CONFLICT (email, date) DO UPDATE SET event_id = EXCLUDED.event_id, event_hash = EXCLUDED.event_hash;
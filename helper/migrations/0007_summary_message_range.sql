@@ -0,0 +1,3 @@
+-- Range of chat_messages ids covered by a summary, messages after last_message_id are the context that follows it.
+ALTER TABLE summaries ADD COLUMN IF NOT EXISTS first_message_id INTEGER;
+ALTER TABLE summaries ADD COLUMN IF NOT EXISTS last_message_id INTEGER;
@@ -0,0 +1,2 @@
+-- Only get_message_count_within_timeframe used this index, messages are rate limited with rate_limits since.
+DROP INDEX IF EXISTS chat_messages_user_email_timestamp_idx;
@@ -0,0 +1,82 @@
+"""Versioned schema migrations, applied once per process when the connection pool is created.
+
+Migrations are the NNNN_description.sql files in this directory, applied in order of NNNN.
+Applied versions are recorded in the schema_version table, so each file only ever runs once per database.
+Scripts under optional/ are never applied automatically, they are run by hand with psql.
+"""
+import os
+import re
+
+from logzero import logger
+
+MIGRATIONS_DIR = os.path.dirname(os.path.abspath(__file__))
+_MIGRATION_FILE = re.compile(r'^(\d+)_(\w+)\.sql$')
+# Arbitrary key, makes concurrent processes starting up wait for each other instead of racing.
+_ADVISORY_LOCK_KEY = 724_105_391
+
+
+def list_migrations() -> list:
+    """
+    Returns a list of (version, name, path) tuples sorted by version.
+    """
+    migrations = []
+    for file_name in os.listdir(MIGRATIONS_DIR):
+        match = _MIGRATION_FILE.match(file_name)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(MIGRATIONS_DIR, file_name)))
+    migrations.sort()
+    versions = [version for version, _, _ in migrations]
+    if len(versions) != len(set(versions)):
+        raise ValueError(f"Duplicate migration versions found in {MIGRATIONS_DIR}")
+    return migrations
+
+
+def get_applied_versions(cursor) -> set:
+    cursor.execute('SELECT version FROM schema_version')
+    return {row[0] for row in cursor.fetchall()}
+
+
+def run_migrations(connection) -> list:
+    """
+    Applies pending migrations, each in its own transaction.
+
+    returns
+    applied: versions that were applied by this call.
+    """
+    cursor = connection.cursor()
+    # Locked before schema_version is created, concurrent CREATE TABLE IF NOT EXISTS on a fresh database collide in pg_type.
+    cursor.execute('SELECT pg_advisory_lock(%s)', (_ADVISORY_LOCK_KEY,))
+    connection.commit()
+    applied = []
+    try:
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        connection.commit()
+        applied_versions = get_applied_versions(cursor)
+        for version, name, path in list_migrations():
+            if version in applied_versions:
+                continue
+            logger.info(f"Applying migration {version:04d}_{name}")
+            with open(path) as migration_file:
+                statements = migration_file.read()
+            try:
+                cursor.execute(statements)
+                cursor.execute('INSERT INTO schema_version (version, name) VALUES (%s, %s)', (version, name))
+                connection.commit()
+            except Exception:
+                connection.rollback()
+                logger.error(f"Migration {version:04d}_{name} failed", exc_info=True)
+                raise
+            applied.append(version)
+    finally:
+        cursor.execute('SELECT pg_advisory_unlock(%s)', (_ADVISORY_LOCK_KEY,))
+        connection.commit()
+        cursor.close()
+    if applied:
+        logger.info(f"Applied migrations {applied}")
+    return applied
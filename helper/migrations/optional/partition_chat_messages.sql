@@ -0,0 +1,56 @@
+-- Optional, not applied by run_migrations: converts chat_messages into a table partitioned by month on
+-- timestamp, so old history can be detached or dropped one month at a time.
+-- Requires migrations up to 0009 to be applied. It copies every row, so run it during a quiet period with
+--   psql "$DATABASE_URL" -f helper/migrations/optional/partition_chat_messages.sql
+-- New monthly partitions are created with: SELECT create_chat_messages_partition('2025-01-01');
+BEGIN;
+
+LOCK TABLE chat_messages IN ACCESS EXCLUSIVE MODE;
+
+ALTER TABLE chat_messages RENAME TO chat_messages_unpartitioned;
+ALTER TABLE chat_messages_unpartitioned RENAME CONSTRAINT chat_messages_pkey TO chat_messages_unpartitioned_pkey;
+ALTER TABLE chat_messages_unpartitioned RENAME CONSTRAINT chat_messages_email_fkey TO chat_messages_unpartitioned_email_fkey;
+ALTER INDEX chat_messages_email_timestamp_idx RENAME TO chat_messages_unpartitioned_email_timestamp_idx;
+ALTER INDEX chat_messages_email_id_idx RENAME TO chat_messages_unpartitioned_email_id_idx;
+
+-- The partition key has to be part of the primary key, ids still come from the original sequence.
+CREATE TABLE chat_messages (
+    id INTEGER NOT NULL DEFAULT nextval('chat_messages_id_seq'),
+    email TEXT,
+    role TEXT,
+    parts TEXT,
+    timestamp TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, timestamp),
+    FOREIGN KEY(email) REFERENCES users(email)
+) PARTITION BY RANGE (timestamp);
+
+ALTER SEQUENCE chat_messages_id_seq OWNED BY chat_messages.id;
+
+CREATE INDEX chat_messages_email_timestamp_idx ON chat_messages (email, timestamp);
+CREATE INDEX chat_messages_email_id_idx ON chat_messages (email, id);
+
+CREATE OR REPLACE FUNCTION create_chat_messages_partition(month_start DATE) RETURNS VOID AS $$
+DECLARE
+    range_start TIMESTAMPTZ := date_trunc('month', month_start);
+BEGIN
+    EXECUTE format(
+        'CREATE TABLE IF NOT EXISTS %I PARTITION OF chat_messages FOR VALUES FROM (%L) TO (%L)',
+        'chat_messages_' || to_char(range_start, 'YYYY_MM'), range_start, range_start + INTERVAL '1 month');
+END;
+$$ LANGUAGE plpgsql;
+
+-- Monthly partitions from the oldest message up to a year ahead, anything outside lands in the default partition.
+SELECT create_chat_messages_partition(month::date)
+FROM generate_series(
+    date_trunc('month', COALESCE((SELECT MIN(timestamp) FROM chat_messages_unpartitioned), CURRENT_TIMESTAMP)),
+    date_trunc('month', CURRENT_TIMESTAMP) + INTERVAL '12 months',
+    INTERVAL '1 month') AS month;
+
+CREATE TABLE chat_messages_default PARTITION OF chat_messages DEFAULT;
+
+INSERT INTO chat_messages (id, email, role, parts, timestamp)
+SELECT id, email, role, parts, COALESCE(timestamp, CURRENT_TIMESTAMP) FROM chat_messages_unpartitioned;
+
+DROP TABLE chat_messages_unpartitioned;
+
+COMMIT;
@@ -0,0 +1,70 @@
+"""Contains the compact encoding of the detailed plan that is sent to the chat model with every message"""
+import datetime
+
+import helper.token_estimator as token_estimator
+
+# Days of the plan around today that are included in the prompt, the rest is available through get_plan_days.
+DAYS_BEFORE_TODAY = 2
+DAYS_AFTER_TODAY = 7
+MAX_TASK_CHARS = 300
+
+
+def _anchor_index(plan: list, today: datetime.date) -> int:
+    """
+    Returns the index of today in the plan, or of the closest end of the plan if today is outside it.
+    """
+    today_str = today.strftime('%Y-%m-%d')
+    for index, day in enumerate(plan):
+        if day['date'] >= today_str:
+            return index
+    return len(plan) - 1
+
+
+def _row(day: dict, include_goal: bool) -> str:
+    task = ' '.join(str(day.get('task', '')).split())
+    if len(task) > MAX_TASK_CHARS:
+        task = task[:MAX_TASK_CHARS] + '...'
+    columns = [day['date'], f"{day.get('start_time', '')}-{day.get('end_time', '')}", task]
+    if include_goal:
+        columns.insert(1, str(day.get('goal', '')))
+    return '|'.join(columns)
+
+
+def encode_plan(plan: list, today: datetime.date = None, max_tokens: int = 1000) -> str:
+    """
+    Encodes the days of the plan around today as a pipe separated table, capped to about `max_tokens` tokens.
+
+    args:
+    plan: list of days of the detailed plan.
+    today: date the window is centred on, defaults to today.
+    max_tokens: days furthest from today are dropped until the estimate fits.
+    returns
+    text: a header describing the whole plan, followed by one row per included day.
+    """
+    today = today or datetime.date.today()
+    goals = {day.get('goal') for day in plan}
+    include_goal = len(goals) > 1
+    anchor = _anchor_index(plan, today)
+    window = list(range(max(0, anchor - DAYS_BEFORE_TODAY), min(len(plan), anchor + DAYS_AFTER_TODAY + 1)))
+    header = f"Plan of {len(plan)} days from {plan[0]['date']} to {plan[-1]['date']}"
+    if not include_goal:
+        header += f", goal: {plan[0].get('goal', '')}"
+    header += ". Only days around today are listed, call get_plan_days for other dates."
+    columns = 'date|goal|time|task' if include_goal else 'date|time|task'
+
+    estimator = token_estimator.get_token_estimator()
+    rows = {index: _row(plan[index], include_goal) for index in window}
+    while len(rows) > 1:
+        text = '\n'.join([header, columns] + [rows[index] for index in sorted(rows)])
+        if estimator.estimate_message({'parts': [text]}) <= max_tokens:
+            return text
+        del rows[max(rows, key=lambda index: abs(index - anchor))]
+    return '\n'.join([header, columns] + [rows[index] for index in sorted(rows)])
+
+
+def get_plan_days(plan: list, start_date: str, end_date: str) -> list:
+    """
+    Returns the days of the plan between start_date and end_date (YYYY-MM-DD), both included.
+    """
+    end_date = end_date or start_date
+    return [day for day in plan if start_date <= day['date'] <= end_date]
@@ -0,0 +1,77 @@
+"""Contains an incremental parser that returns the days of a streamed plan response as soon as each one is complete"""
+import json
+
+from logzero import logger
+
+
+class PlanStreamParser:
+    """
+    Consumes the text of a plan response chunk by chunk, e.g. {"plan": [{"date": ...}, {"date": ...}]} or a bare list of days.
+    Every day object is decoded as soon as its closing brace arrives, so a truncated response still gives the valid prefix.
+    """
+    def __init__(self):
+        self._buffer = []
+        self._depth = 0
+        self._day_depth = None
+        self._in_string = False
+        self._escaped = False
+        self.complete = False
+
+    def feed(self, text: str) -> list:
+        """
+        Consumes the next chunk of text and returns the day objects completed by it.
+        """
+        days = []
+        for char in text:
+            if self._day_depth is None:
+                if char.isspace():
+                    continue
+                # A bare list holds the days at depth 1, the {"plan": [...]} format at depth 2.
+                self._day_depth = 1 if char == '[' else 2
+            if self._depth >= self._day_depth:
+                self._buffer.append(char)
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                continue
+            if char == '"':
+                self._in_string = True
+            elif char == '{':
+                self._depth += 1
+                if self._depth == self._day_depth:
+                    self._buffer = [char]
+            elif char == '}':
+                self._depth -= 1
+                if self._depth == self._day_depth - 1 and self._buffer:
+                    day = self._decode(''.join(self._buffer))
+                    self._buffer = []
+                    if day is not None:
+                        days.append(day)
+                if self._depth == 0 and self._day_depth == 2:
+                    self.complete = True
+            elif char == ']' and self._day_depth == 1 and self._depth == 0:
+                self.complete = True
+        return days
+
+    @staticmethod
+    def _decode(text: str):
+        try:
+            return json.loads(text)
+        except json.JSONDecodeError:
+            logger.warning(f"Skipping malformed day in plan response: {text[:200]}")
+            return None
+
+
+def iter_plan_days(text_chunks):
+    """
+    Yields each day of a plan as soon as it is complete, from an iterable of text chunks.
+    """
+    parser = PlanStreamParser()
+    for text in text_chunks:
+        yield from parser.feed(text)
+    if not parser.complete:
+        logger.warning("Plan response ended before the plan was complete")
@@ -0,0 +1,99 @@
+"""Contains a per user token bucket rate limiter for chat messages, with pluggable storage backends"""
+import datetime
+import threading
+import time
+
+import streamlit as st
+from logzero import logger
+
+import helper.database_functions as db_funcs
+
+
+class InMemoryBackend:
+    """
+    Keeps buckets in a dict shared by every session of this process. Counts are lost on restart.
+    Buckets that have been full for a whole timeframe are evicted, a missing bucket is the same as a full one.
+    """
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+
+    def take(self, key: str, capacity: float, refill_per_second: float) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_sweep >= capacity / refill_per_second:
+                self._evict_idle(now, capacity, refill_per_second)
+            tokens, updated_at = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated_at) * refill_per_second)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+        return allowed
+
+    def _evict_idle(self, now: float, capacity: float, refill_per_second: float):
+        """
+        Runs at most once per timeframe, the time an empty bucket takes to refill. Called with the lock held.
+        """
+        timeframe = capacity / refill_per_second
+        idle_keys = [
+            key for key, (tokens, updated_at) in self._buckets.items()
+            if now - updated_at - (capacity - tokens) / refill_per_second >= timeframe
+        ]
+        for key in idle_keys:
+            del self._buckets[key]
+        self._last_sweep = now
+        if idle_keys:
+            logger.debug(f"Evicted {len(idle_keys)} idle rate limit buckets, {len(self._buckets)} left")
+
+
+class PostgresBackend:
+    """
+    Keeps buckets in the rate_limits table, so limits hold across processes and restarts.
+    Refill and take happen in a single atomic upsert, no rows of chat_messages are read.
+    """
+    def take(self, key: str, capacity: float, refill_per_second: float) -> bool:
+        with db_funcs.get_connection() as (connection, cursor):
+            return db_funcs.take_rate_limit_token(cursor, connection, key, capacity, refill_per_second)
+
+
+_BACKENDS = {
+    'memory': InMemoryBackend,
+    'postgres': PostgresBackend,
+}
+
+
+class RateLimiter:
+    """
+    Token bucket allowing `limit` messages per `timeframe`, refilled continuously.
+
+    args:
+    backend: storage of the buckets, InMemoryBackend or PostgresBackend.
+    limit: number of messages a user can send in a burst, and per timeframe.
+    timeframe: datetime.timedelta over which `limit` tokens are refilled.
+    """
+    def __init__(self, backend, limit: int, timeframe: datetime.timedelta):
+        self.backend = backend
+        self.capacity = float(limit)
+        self.refill_per_second = limit / timeframe.total_seconds()
+
+    def try_acquire(self, email: str) -> bool:
+        """
+        Takes one token from the user's bucket. Returns False if the user is rate limited.
+        """
+        allowed = self.backend.take(email, self.capacity, self.refill_per_second)
+        if not allowed:
+            logger.debug(f"User {email} is rate limited")
+        return allowed
+
+
+@st.cache_resource(show_spinner=False)
+def get_rate_limiter(limit: int, timeframe_in_mins: int) -> RateLimiter:
+    """
+    Creates the rate limiter once per process. The backend is picked with the `rate_limit_backend` secret, defaults to memory.
+    """
+    backend_name = st.secrets.get('rate_limit_backend', 'memory')
+    if backend_name not in _BACKENDS:
+        raise ValueError(f"Unknown rate_limit_backend '{backend_name}', expected one of {list(_BACKENDS)}")
+    return RateLimiter(_BACKENDS[backend_name](), limit, datetime.timedelta(minutes=timeframe_in_mins))
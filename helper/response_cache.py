@@ -0,0 +1,176 @@
+"""Contains a content addressed cache of model responses, with disk and postgres storage backends"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+import streamlit as st
+from logzero import logger
+
+import helper.database_functions as db_funcs
+
+
+def response_key(model_name: str, system_instruction: str, messages: list, params: dict = None) -> str:
+    """
+    Returns a hash identifying a request. Messages are normalised to role and whitespace collapsed text,
+    so requests that only differ in formatting share a key.
+    """
+    normalised = [
+        {"role": message["role"], "parts": [' '.join(str(part).split()) for part in message["parts"]]}
+        for message in messages
+    ]
+    request = {
+        "model": model_name,
+        "system_instruction": ' '.join(system_instruction.split()),
+        "messages": normalised,
+        "params": params or {},
+    }
+    return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class DiskBackend:
+    """
+    Keeps one json file per response in `directory`. The modification time of a file is its last use.
+    """
+    def __init__(self, directory: str = '.response_cache'):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key: str, ttl: float):
+        path = self._path(key)
+        try:
+            with open(path, encoding='utf-8') as file:
+                entry = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry['created_at'] > ttl:
+            return None
+        os.utime(path)
+        return entry['response']
+
+    def put(self, key: str, model_name: str, response, ttl: float, max_entries: int):
+        path = self._path(key)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump({'model': model_name, 'created_at': time.time(), 'response': response}, file)
+        os.replace(temp_path, path)
+        with self._lock:
+            self._evict(ttl, max_entries)
+
+    def _evict(self, ttl: float, max_entries: int):
+        """
+        Removes expired files, then the least recently used ones beyond max_entries.
+        """
+        entries = []
+        now = time.time()
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                entries.append((os.path.getmtime(path), path))
+            except OSError:
+                continue
+        entries.sort(reverse=True)
+        for index, (last_used, path) in enumerate(entries):
+            # Files aren't read to check created_at here, a file unused for longer than ttl is expired anyway.
+            if index >= max_entries or now - last_used > ttl:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+class PostgresBackend:
+    """
+    Keeps responses in the response_cache table, so they are shared across processes and restarts.
+    """
+    def get(self, key: str, ttl: float):
+        with db_funcs.get_connection() as (connection, cursor):
+            return db_funcs.get_cached_response(cursor, connection, key, ttl)
+
+    def put(self, key: str, model_name: str, response, ttl: float, max_entries: int):
+        with db_funcs.get_connection() as (connection, cursor):
+            db_funcs.save_cached_response(cursor, connection, key, model_name, response, ttl, max_entries)
+
+
+_BACKENDS = {
+    'disk': DiskBackend,
+    'postgres': PostgresBackend,
+}
+
+
+class ResponseCache:
+    """
+    Serves responses of requests seen within `ttl` seconds, keeping at most `max_entries` responses,
+    least recently used first out. Hits and misses are counted per model.
+
+    args:
+    backend: storage of the responses, DiskBackend or PostgresBackend.
+    ttl: seconds a response is served from the cache.
+    max_entries: number of responses kept.
+    """
+    def __init__(self, backend, ttl: float = 86400, max_entries: int = 1000):
+        self.backend = backend
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def get(self, model_name: str, key: str):
+        """
+        Returns the cached response, or None on a miss. Storage errors are logged and counted as misses.
+        """
+        try:
+            response = self.backend.get(key, self.ttl)
+        except Exception:
+            logger.warning("Response cache lookup failed", exc_info=True)
+            response = None
+        with self._lock:
+            counts = self._counts.setdefault(model_name, {'hits': 0, 'misses': 0})
+            counts['hits' if response is not None else 'misses'] += 1
+        if response is not None:
+            logger.info(f"Response served from cache for {model_name}, hit ratio {self.hit_ratio(model_name):.2f}")
+        return response
+
+    def put(self, model_name: str, key: str, response):
+        try:
+            self.backend.put(key, model_name, response, self.ttl, self.max_entries)
+        except Exception:
+            logger.warning("Response could not be cached", exc_info=True)
+
+    def hit_ratio(self, model_name: str) -> float:
+        with self._lock:
+            counts = self._counts.get(model_name, {'hits': 0, 'misses': 0})
+            total = counts['hits'] + counts['misses']
+            return counts['hits'] / total if total else 0.0
+
+    def stats(self) -> dict:
+        """
+        Returns hits, misses and the hit ratio of every model.
+        """
+        with self._lock:
+            return {
+                model_name: {**counts, 'hit_ratio': counts['hits'] / (counts['hits'] + counts['misses'])}
+                for model_name, counts in self._counts.items()
+            }
+
+
+@st.cache_resource(show_spinner=False)
+def get_response_cache() -> ResponseCache:
+    """
+    Creates the response cache once per process. The backend is picked with the `response_cache_backend` secret, defaults to disk.
+    """
+    backend_name = st.secrets.get('response_cache_backend', 'disk')
+    if backend_name not in _BACKENDS:
+        raise ValueError(f"Unknown response_cache_backend '{backend_name}', expected one of {list(_BACKENDS)}")
+    backend = DiskBackend(st.secrets.get('response_cache_dir', '.response_cache')) if backend_name == 'disk' else PostgresBackend()
+    return ResponseCache(
+        backend,
+        ttl=st.secrets.get('response_cache_ttl_in_secs', 86400),
+        max_entries=st.secrets.get('response_cache_max_entries', 1000))
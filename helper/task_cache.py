@@ -0,0 +1,74 @@
+"""Contains a short lived, per user cache of tasks fetched from google tasks"""
+import threading
+import time
+from collections import OrderedDict
+
+import streamlit as st
+from logzero import logger
+
+
+class TaskCache:
+    """
+    Caches fetched tasks per user and query for `ttl` seconds. Users are evicted least recently used first,
+    once more than `max_users` users have cached tasks.
+
+    args:
+    ttl: seconds a fetched result is served from the cache.
+    max_users: number of users whose tasks are kept.
+    """
+    def __init__(self, ttl: float = 60, max_users: int = 500):
+        self.ttl = ttl
+        self.max_users = max_users
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, email: str, query: tuple):
+        """
+        Returns the cached tasks of the user for the query, or None if missing or expired.
+        """
+        now = time.monotonic()
+        with self._lock:
+            user_entries = self._entries.get(email)
+            entry = user_entries.get(query) if user_entries else None
+            if entry is None or now - entry[0] > self.ttl:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(email)
+            self.hits += 1
+        logger.debug(f"Tasks served from cache for {email}, {self.hits} hits and {self.misses} misses so far")
+        return list(entry[1])
+
+    def put(self, email: str, query: tuple, tasks: list):
+        with self._lock:
+            user_entries = self._entries.setdefault(email, {})
+            user_entries[query] = (time.monotonic(), list(tasks))
+            self._entries.move_to_end(email)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, email: str):
+        """
+        Drops every cached result of the user, called whenever the user's tasks are written.
+        """
+        with self._lock:
+            self._entries.pop(email, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / total if total else 0.0,
+                'users': len(self._entries),
+            }
+
+
+@st.cache_resource(show_spinner=False)
+def get_task_cache() -> TaskCache:
+    """
+    Creates the task cache once per process, so it is shared by every session.
+    """
+    return TaskCache(ttl=st.secrets.get('task_cache_ttl_in_secs', 60))
@@ -0,0 +1,84 @@
+"""Contains a local token count estimator, so deciding when to summarise needs no network call"""
+import math
+import threading
+
+import streamlit as st
+from logzero import logger
+
+# Gemini averages about 4 characters per token for english text, calibration adjusts this per process.
+DEFAULT_CHARS_PER_TOKEN = 4.0
+# Fixed cost of the role and turn markers of every message.
+TOKENS_PER_MESSAGE = 4
+
+
+def _message_chars(message) -> int:
+    parts = message.get('parts', [])
+    if isinstance(parts, str):
+        return len(parts)
+    return sum(len(part) if isinstance(part, str) else len(str(part)) for part in parts)
+
+
+class TokenEstimator:
+    """
+    Estimates token counts from character counts, and calibrates the characters per token ratio
+    against the model's count_tokens every `calibrate_every` estimates.
+
+    args:
+    chars_per_token: starting ratio used for estimates.
+    calibrate_every: number of estimates between two remote calibration checks, 0 disables calibration.
+    """
+    def __init__(self, chars_per_token: float = DEFAULT_CHARS_PER_TOKEN, calibrate_every: int = 25):
+        self.chars_per_token = chars_per_token
+        self.calibrate_every = calibrate_every
+        self._estimates = 0
+        self._lock = threading.Lock()
+
+    def estimate_message(self, message: dict) -> int:
+        """
+        Returns the estimated tokens of a single message.
+        """
+        return math.ceil(_message_chars(message) / self.chars_per_token) + TOKENS_PER_MESSAGE
+
+    def estimate(self, messages: list) -> int:
+        """
+        Returns the estimated tokens of a list of messages.
+        """
+        return sum(self.estimate_message(message) for message in messages)
+
+    def maybe_calibrate(self, model, messages: list):
+        """
+        Every `calibrate_every` calls, compares the estimate with the model's count_tokens in a background thread.
+        """
+        if not self.calibrate_every or not messages:
+            return
+        with self._lock:
+            self._estimates += 1
+            if self._estimates % self.calibrate_every:
+                return
+        threading.Thread(target=self.calibrate, args=(model, list(messages)), daemon=True).start()
+
+    def calibrate(self, model, messages: list):
+        """
+        Moves chars_per_token towards the ratio measured with a remote count_tokens call.
+        """
+        try:
+            actual = model.count_tokens(messages).total_tokens
+        except Exception:
+            logger.warning("Token count calibration failed", exc_info=True)
+            return
+        estimated = self.estimate(messages)
+        text_tokens = actual - TOKENS_PER_MESSAGE * len(messages)
+        if text_tokens <= 0:
+            return
+        measured = sum(_message_chars(message) for message in messages) / text_tokens
+        with self._lock:
+            self.chars_per_token = min(10.0, max(1.0, 0.8 * self.chars_per_token + 0.2 * measured))
+        logger.debug(f"Token estimate {estimated} vs actual {actual}, chars per token is now {self.chars_per_token:.2f}")
+
+
+@st.cache_resource(show_spinner=False)
+def get_token_estimator() -> TokenEstimator:
+    """
+    Creates the token estimator once per process, so calibration is shared by every session.
+    """
+    return TokenEstimator(calibrate_every=st.secrets.get('token_calibration_interval', 25))
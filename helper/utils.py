@@ -1,17 +1,31 @@
 """Contains utility functions"""
+import hashlib
+import json
 import random
 import streamlit as st
 import datetime
 import datetime
 
+import google_auth_httplib2
+import httplib2
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build_from_document
 from googleapiclient.errors import HttpError
 from logzero import logger
 
+import helper.chat_writer as chat_writer
 import helper.database_functions as db_funcs
+import helper.google_sync as google_sync
+import helper.plan_context as plan_context
+import helper.task_cache as task_cache
+from helper.conversation import ConversationContext
 
 SCOPES = ['https://www.googleapis.com/auth/calendar', 'https://www.googleapis.com/auth/tasks']
+# Number of users whose credentials are kept, least recently used ones are dropped first.
+CREDENTIALS_CACHE_SIZE = 256
+# Number of chat messages displayed at first, and loaded each time older messages are requested.
+CHAT_PAGE_SIZE = 50
 
 def initialize_variables():
     """
@@ -23,15 +37,15 @@ def initialize_variables():
     st.session_state['start_time'] = None
     st.session_state['end_time'] = None
     st.session_state['display_messages'] = []
-    st.session_state['messages'] = []
+    st.session_state['messages'] = ConversationContext()
     st.session_state['latest_summary'] = None
+    st.session_state['pending_summary'] = None
     st.session_state['initialized'] = True
-    st.session_state['chat_model'] = None
-    st.session_state['plan_model'] = None
     st.session_state['plan'] = None
     st.session_state['task_ids_generated'] = False
     st.session_state['goal_title'] = None
     st.session_state['calendar_service'] = None
+    st.session_state['tasks_service'] = None
     st.session_state['timezone'] = None
     st.session_state['rate_limit'] = st.secrets['message_rate_limit']
     st.session_state['timeframe'] = st.secrets['timeframe_in_mins']
@@ -39,23 +53,84 @@ def initialize_variables():
     
 def initialize_previous_messages():
     """
-    initializes and loads user's previous messages.
+    initializes and loads user's previous messages. Only the latest CHAT_PAGE_SIZE messages are displayed, older ones are loaded on request.
     """
-    if not st.session_state['display_messages']:
-        st.session_state['display_messages'] = cached_get_user_chat_messages(st.session_state['user_info']['email'], None)
-    
     if 'messages_loaded' not in st.session_state:
         # with st.spinner("Fetching previous messages"):
+        email = st.session_state['user_info']['email']
         logger.info("Summary is being fetched")
-        summary, latest_summary_timestamp = cached_get_latest_summary(st.session_state['user_info']['email'])
+        summary, latest_summary_timestamp, last_summarised_id = cached_get_latest_summary(email)
         st.session_state['latest_summary'] = summary
-        if summary:
-            new_messages = cached_get_user_chat_messages(st.session_state['user_info']['email'], latest_summary_timestamp)
-            st.session_state['messages'] = new_messages
-        else:
-            st.session_state['messages'] = st.session_state['display_messages']
+        # Messages aren't cached across sessions, every saved turn would make the cached history stale.
+        with db_funcs.get_connection() as (db, cursor):
+            if last_summarised_id:
+                messages = db_funcs.get_user_chat_messages(cursor, email, after_id=last_summarised_id)
+            elif summary:
+                # Summaries saved before message ids were recorded only have a timestamp.
+                messages = db_funcs.get_user_chat_messages(cursor, email, latest_summary_timestamp)
+            else:
+                messages = db_funcs.get_user_chat_messages(cursor, email)
+        st.session_state['messages'] = ConversationContext(messages)
+        # The displayed page comes from the same rows, messages covered by the summary are older and loaded on request.
+        _set_displayed_page(messages[-(CHAT_PAGE_SIZE + 1):], has_older=bool(summary))
         st.session_state['messages_loaded'] = True
-        logger.info(f"Messages are initialised for {st.session_state['user_info']['email']}")
+        logger.info(f"Messages are initialised for {email}")
+
+def load_older_messages():
+    """
+    Prepends the previous page of messages to the displayed messages, using the id of the oldest displayed message as the key.
+    """
+    if not st.session_state.get('has_older_messages'):
+        return
+    oldest_id = st.session_state['oldest_displayed_id']
+    displayed_messages = st.session_state['display_messages']
+    if oldest_id is None and displayed_messages:
+        # The page was empty when loaded (e.g. every message was summarised or the chat was reset),
+        # the messages shown since then are keyed by their saved ids. Without a key the latest messages would be loaded again.
+        oldest_id = displayed_messages[0].get('id')
+        if oldest_id is None:
+            return
+    with db_funcs.get_connection() as (db, cursor):
+        older_messages = db_funcs.get_user_chat_messages_page(cursor, st.session_state['user_info']['email'], oldest_id, CHAT_PAGE_SIZE + 1)
+    _set_displayed_page(older_messages)
+    st.session_state['display_messages'] = st.session_state['display_messages'] + displayed_messages
+
+def _set_displayed_page(messages: list, has_older: bool = False):
+    """
+    Displays the page, messages must hold one message more than CHAT_PAGE_SIZE if older messages exist, or has_older must be set.
+    """
+    st.session_state['has_older_messages'] = has_older or len(messages) > CHAT_PAGE_SIZE
+    st.session_state['display_messages'] = messages[-CHAT_PAGE_SIZE:]
+    st.session_state['oldest_displayed_id'] = st.session_state['display_messages'][0]['id'] if st.session_state['display_messages'] else None
+
+def save_chat_turn(prompt: str, response_text: str = None):
+    """
+    Saves the user message and the model response of a turn in one transaction, after the response is shown.
+    Only the user message is saved if no response was generated. The turn's messages must be the latest ones
+    in the conversation and the displayed messages, their ids are set there.
+    With the `chat_write_behind` secret set, the turn is queued and saved in the background with other sessions' turns.
+    """
+    email = st.session_state['user_info']['email']
+    rows = [(email, "user", prompt)]
+    if response_text is not None:
+        rows.append((email, "model", response_text))
+    if st.secrets.get('chat_write_behind', False):
+        message_ids = chat_writer.get_chat_writer().submit(rows)
+        for message, future in zip(st.session_state['display_messages'][-len(rows):], message_ids):
+            future.add_done_callback(lambda done, message=message: _set_saved_id(message, done))
+    else:
+        with db_funcs.get_connection() as (db, cursor):
+            message_ids = db_funcs.save_chat_messages(cursor, db, rows)
+        for message, message_id in zip(st.session_state['display_messages'][-len(rows):], message_ids):
+            message['id'] = message_id
+    st.session_state['messages'].assign_ids(message_ids)
+
+def _set_saved_id(message: dict, future):
+    """
+    Runs on the chat writer's thread once a queued message is written, so it only sets the id on the message dict.
+    """
+    if future.exception() is None:
+        message['id'] = future.result()
 
 def _initialize_api_key():
     """
@@ -65,21 +140,10 @@ def _initialize_api_key():
         st.session_state['gemini_api_key'] = random.choice(list(st.secrets['api_keys'].values()))
         logger.debug(f"This session uses the key {st.session_state['gemini_api_key']}")
 
-@st.cache_data(show_spinner=False)
-def cached_get_user_chat_messages(email: str, timestamp=None):
-    db, cursor = db_funcs.initialize_database()
-    return db_funcs.get_user_chat_messages(cursor, email, timestamp)
-
 @st.cache_data(show_spinner=False)
 def cached_get_latest_summary(email: str):
-    db, cursor = db_funcs.initialize_database()
-    return db_funcs.get_latest_summary(cursor, email)
-
-@st.cache_data(ttl=300)  # Cache for 5 minutes
-def cached_get_message_count(email, timeframe):
-    """Cache function to fetch message count"""
-    db, cursor = db_funcs.initialize_database()
-    return db_funcs.get_message_count_within_timeframe(cursor, email, timeframe)
+    with db_funcs.get_connection() as (db, cursor):
+        return db_funcs.get_latest_summary(cursor, email)
 
 def check_if_user_loggedin():
     if 'user_info' not in st.session_state:
@@ -127,7 +191,7 @@ def initialise_ui_layout_todolist_page():
     st.divider()
 
 @st.dialog("Delete chat", width="small")
-def delete_chat_records(cursor, connection):
+def delete_chat_records():
     """
     Function to clear chat records from the user. This function is called when the Delete chat button is clicked.
     """
@@ -135,14 +199,16 @@ def delete_chat_records(cursor, connection):
     st.write("Type '**delete chat**' to proceed")
     delete_check = st.text_input("Enter delete key")
     if st.button("Submit") and delete_check == "delete chat":
-        db_funcs.delete_chat(cursor, connection, st.session_state['user_info']['email'])
+        with db_funcs.get_connection() as (connection, cursor):
+            db_funcs.delete_chat(cursor, connection, st.session_state['user_info']['email'])
         st.session_state['display_messages'] = []
-        st.session_state['messages'] = []
-        cached_get_user_chat_messages.clear()
+        st.session_state['has_older_messages'] = False
+        st.session_state['oldest_displayed_id'] = None
+        st.session_state['messages'].clear()
         st.rerun()
 
 @st.dialog("Delete summary", width="small")
-def delete_summary_records(cursor, connection):
+def delete_summary_records():
     """
     Function to clear summary maintained by the model. This function is called when the Delete summary button is clicked.
     """
@@ -150,13 +216,15 @@ def delete_summary_records(cursor, connection):
     st.write("Type '**delete summary**' to proceed")
     delete_check = st.text_input("Enter delete key")
     if st.button("Submit") and delete_check == "delete summary":
-        db_funcs.delete_summaries(cursor, connection, st.session_state['user_info']['email'])
+        with db_funcs.get_connection() as (connection, cursor):
+            db_funcs.delete_summaries(cursor, connection, st.session_state['user_info']['email'])
         st.session_state['latest_summary'] = None
+        st.session_state['pending_summary'] = None
         cached_get_latest_summary.clear()
         st.rerun()
 
 @st.dialog("Delete detailed plan", width="small")
-def delete_plan_records(cursor, connection):
+def delete_plan_records():
     """
     Function to clear detailed plan records from the user. This function is called when the Delete detailed plan button is clicked.
     """
@@ -164,41 +232,64 @@ def delete_plan_records(cursor, connection):
     st.write("Type '**delete plan**' to proceed")
     delete_check = st.text_input("Enter delete key")
     if st.button("Submit") and delete_check == "delete plan":
-        db_funcs.delete_plan(cursor, connection, st.session_state['user_info']['email'])
+        with db_funcs.get_connection() as (connection, cursor):
+            db_funcs.delete_plan(cursor, connection, st.session_state['user_info']['email'])
         st.session_state['plan'] = None
         st.rerun()
 
-def get_calendar_service():
-    creds = Credentials(
-        token=st.session_state['credentials']['token'],
-        refresh_token=st.session_state['credentials']['refresh_token'],
-        token_uri=st.session_state['credentials']['token_uri'],
+def _get_credentials_key() -> str:
+    """
+    Returns a key identifying the logged in user's credentials, without exposing the tokens themselves.
+    """
+    credentials = st.session_state['credentials']
+    identity = credentials['refresh_token'] or credentials['token']
+    return hashlib.sha256(f"{st.secrets['google_oauth']['client_id']}:{identity}".encode('utf-8')).hexdigest()
+
+@st.cache_resource(show_spinner=False, max_entries=CREDENTIALS_CACHE_SIZE)
+def _get_credentials(credentials_key: str, _credentials_info: dict) -> Credentials:
+    """
+    Creates the user's credentials once, so a refreshed token is reused by every later service of the user.
+    _credentials_info is not hashed, credentials_key identifies it.
+    """
+    return Credentials(
+        token=_credentials_info['token'],
+        refresh_token=_credentials_info['refresh_token'],
+        token_uri=_credentials_info['token_uri'],
         client_id=st.secrets['google_oauth']['client_id'],
         client_secret=st.secrets['google_oauth']['client_secret'],
         scopes=SCOPES
     )
+
+@st.cache_resource(show_spinner=False)
+def _get_discovery_document(api_name: str, api_version: str) -> dict:
+    """
+    Reads and parses the discovery document bundled with the client library once per api.
+    """
+    return json.loads(discovery_cache.get_static_doc(api_name, api_version))
+
+def _get_service(api_name: str, api_version: str):
+    """
+    Builds a service once per session and keeps it in st.session_state as `<api_name>_service`.
+    httplib2 transports are not thread-safe, so sessions don't share one, a session's script runs on one thread at a time.
+    Credentials and discovery documents are cached across sessions.
+    """
+    key = f'{api_name}_service'
+    if st.session_state.get(key):
+        return st.session_state[key]
     try:
-        service = build('calendar', 'v3', credentials=creds)
-        return service
+        credentials = _get_credentials(_get_credentials_key(), st.session_state['credentials'])
+        http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http(timeout=30))
+        st.session_state[key] = build_from_document(_get_discovery_document(api_name, api_version), http=http)
     except HttpError as error:
         st.error(f'An error occurred: {error}')
         return None
-      
+    return st.session_state[key]
+
+def get_calendar_service():
+    return _get_service('calendar', 'v3')
+
 def _get_tasks_service():
-    creds = Credentials(
-        token=st.session_state['credentials']['token'],
-        refresh_token=st.session_state['credentials']['refresh_token'],
-        token_uri=st.session_state['credentials']['token_uri'],
-        client_id=st.secrets['google_oauth']['client_id'],
-        client_secret=st.secrets['google_oauth']['client_secret'],
-        scopes=SCOPES
-    )
-    try:
-        service = build('tasks', 'v1', credentials=creds)
-        return service
-    except HttpError as error:
-        st.error(f'An error occurred: {error}')
-        return None
+    return _get_service('tasks', 'v1')
 
 def map_composite_to_dict(map_composite):
     """
@@ -220,12 +311,15 @@ def map_composite_to_dict(map_composite):
             result[key] = str(value)
     return result
 
-def fetch_tasks_from_google_tasks(due_date :str =None) -> list:
+def fetch_tasks_from_google_tasks(due_date :str =None, start_date :str =None, end_date :str =None) -> list:
     """
-    Fetches all tasks from user's default tasklist and optionally filters by due date.
+    Fetches tasks from user's default tasklist, optionally only the ones due on a date or within a date range.
 
     Args:
-        due_date: date must be in YYYY-MM-DD format, if no date is provided, date is set to None and all tasks are fetched.
+        due_date: date must be in YYYY-MM-DD format, fetches tasks due on this date. If no date is provided, date is set to None.
+        start_date: date must be in YYYY-MM-DD format, fetches tasks due on or after this date. Defaults to None.
+        end_date: date must be in YYYY-MM-DD format, fetches tasks due on or before this date. Defaults to None.
+        If none of the dates are provided, all tasks are fetched.
     Returns:
         A list of dictionaries containing:
         title: title of the task.
@@ -234,34 +328,72 @@ def fetch_tasks_from_google_tasks(due_date :str =None) -> list:
         notes: detailed description of the task, defaults to empty string.
         web_link: a web viewable link of the task, defaults to empty string.
     """
+    if due_date:
+        start_date = end_date = due_date
+    email = st.session_state['user_info']['email']
+    cache = task_cache.get_task_cache()
+    cached_tasks = cache.get(email, (start_date, end_date))
+    if cached_tasks is not None:
+        return cached_tasks
     tasks_service = _get_tasks_service()
     logger.debug("fetching tasks now")
     function_result = []
     if tasks_service:
         try:
-            results = tasks_service.tasks().list(tasklist='@default', showHidden=True).execute()
-            items = results.get('items', [])
-            if due_date:
-                items = [item for item in items if 'due' in item and item['due'][:10] == due_date]
-            logger.debug(f"tasks are {items}")
-            for item in items:
+            for item in google_sync.iter_tasks(tasks_service, start_date, end_date):
                 function_result.append({'title': item['title'],
                                     'due': item['due'],
                                     'task_status': item['status'],
                                     'notes': item.get('notes', ''),
                                     'web_link': item.get('webViewLink', '')})
+            logger.debug(f"fetched {len(function_result)} tasks")
+            cache.put(email, (start_date, end_date), function_result)
         except HttpError as error:
             st.error(f'An error occurred: {error}')
             function_result.append(f'An error occurred: {error}')
     return function_result
            
+def get_plan_days(start_date: str = None, end_date: str = None) -> list:
+    """
+    Fetches the days of the user's detailed plan within a date range.
+
+    Args:
+        start_date: date must be in YYYY-MM-DD format, first day to fetch. If no date is provided, the timeline's start date is used.
+        end_date: date must be in YYYY-MM-DD format, last day to fetch. If no date is provided, only start_date is fetched,
+        or the whole timeline if start_date is missing too.
+    Returns:
+        A list of dictionaries containing:
+        date: date of the day in the plan.
+        task: detailed task for the day.
+        goal: goal the task belongs to.
+        start_time: time the task starts.
+        end_time: time the task ends.
+    """
+    if not st.session_state.get('plan'):
+        return ["No plan has been created, please generate a plan by clicking the 'Generate and View Plan' button."]
+    plan = st.session_state['plan']
+    if not start_date:
+        start_date = _format_date(st.session_state.get('start_date')) or plan[0]['date']
+        end_date = end_date or _format_date(st.session_state.get('end_date')) or plan[-1]['date']
+    try:
+        for date in (start_date, end_date or start_date):
+            datetime.datetime.strptime(date, '%Y-%m-%d')
+    except (TypeError, ValueError):
+        return [f"Dates must be in YYYY-MM-DD format, got start_date={start_date} and end_date={end_date}."]
+    return plan_context.get_plan_days(plan, start_date, end_date)
+
+def _format_date(date) -> str:
+    return date.strftime('%Y-%m-%d') if date else None
+
 def add_or_update_task_to_google_tasks(dummy_arg: str = "") -> list:
     """
     Adds a new task or updates an existing one to google tasks to the user's default tasklist.
+    Only days that changed since the last sync are sent, tasks for dates no longer in the plan are removed.
     Args:
         dummy_str: Just feed in a dummy string here, this is to bypass gemini's fuction declaration
     Returns:
-        A list of dictionaries containing:
+        A list whose first item has the counts of created, updated, unchanged and deleted tasks,
+        followed by dictionaries of created and updated tasks containing:
         title: contains title of the task.
         due: contains the date when the task is due.
         status: status of the task, if not completed returns needsAction.
@@ -272,39 +404,15 @@ def add_or_update_task_to_google_tasks(dummy_arg: str = "") -> list:
         return ["No plan has been created, please generate a plan by clicking the 'Generate and View Plan' button."]
     
     logger.debug("inside the function")
-    db, cursor = db_funcs.initialize_database()
-    function_result = []
-    existing_task_ids_in_db = db_funcs.fetch_task_ids(cursor, st.session_state['user_info']['email'])
+    email = st.session_state['user_info']['email']
+    with db_funcs.get_connection() as (db, cursor):
+        existing_task_ids_in_db = db_funcs.fetch_task_ids(cursor, email)
     tasks_service = _get_tasks_service()
-    for day in st.session_state['plan']:
-        date_obj = datetime.datetime.strptime(day['date'], "%Y-%m-%d").date()
-        time_obj = datetime.datetime.strptime(day['end_time'], "%H:%M:%S").time()
-        due = datetime.datetime.combine(date_obj, time_obj).isoformat() + 'Z'
-        existing_task_id = existing_task_ids_in_db.get(day['date'], None)
-        task = {
-            'title': st.session_state['goal_title'],
-            'due': due,
-        }
-        if day['task']:
-            task['notes'] = day['task']
-        try:
-            if existing_task_id:
-                # Update the existing task
-                result = tasks_service.tasks().patch(tasklist='@default', task=existing_task_id, body=task).execute()
-                logger.debug("Update existing google tasks")
-            else:
-                # Add a new task
-                result = tasks_service.tasks().insert(tasklist='@default', body=task).execute()
-            function_result.append({'title': result['title'],
-                                'due': result['due'],
-                                'status': result['status'],
-                                'notes': result.get('notes', ''),
-                                'web_link': result.get('webViewLink', '')})
-            db_funcs.save_task_ids(cursor, db, st.session_state['user_info']['email'], result['id'], date_obj)
-            # logger.debug("Saved and added to google tasks")
-        except HttpError as error:
-            logger.debug("error when syncing")
-            function_result.append(f'An error occurred while adding/updating the task: {error}')
+    function_result, task_ids = google_sync.sync_plan_to_tasks(tasks_service, st.session_state['plan'], st.session_state['goal_title'], existing_task_ids_in_db)
+    task_cache.get_task_cache().invalidate(email)
+    if task_ids != existing_task_ids_in_db:
+        with db_funcs.get_connection() as (db, cursor):
+            db_funcs.save_task_ids(cursor, db, email, task_ids)
     st.session_state['task_ids_generated'] = True
     return function_result
 
@@ -315,29 +423,3 @@ def get_user_timezone(service):
     except HttpError as error:
         st.error(f'An error occurred: {error}')
         return 'UTC'
-
-def _create_calendar_event(service, start_date, end_date, summary, description, timezone):
-    """
-    Creates a calendar event based on the detailed plan generated.
-    Args:
-        service: A Resource object with methods for interacting with the service
-        start_date: start_date of the event
-        end_date: end_date of the event 
-        summary: summary of the plan for the day
-        description: Description of the event
-        timezone: timezone of the user.
-    """
-    event = {
-        'summary': summary,
-        'description': description,
-        'start': {
-            'dateTime': start_date.isoformat(),
-            'timeZone': timezone,
-        },
-        'end': {
-            'dateTime': end_date.isoformat(),
-            'timeZone': timezone,
-        },
-    }
-    event = service.events().insert(calendarId='primary', body=event).execute()
-    return event
\ No newline at end of file
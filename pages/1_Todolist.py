@@ -1,11 +1,10 @@
 """Main layout of the Todolist tab."""
 from logzero import logger
 import streamlit as st
-import datetime
 
 import helper.utils as utils
 import helper.llm_utils as llm_utils
-import helper.database_functions as db_funcs
+import helper.rate_limiter as rate_limiter
 import column_2
 
 def initialise_side_bar_components():
@@ -42,19 +41,17 @@ def initialise_side_bar_components():
                 st.write("Summary hasn't been generated so far, continue talking with the agent")
 
         if st.button("Reset chat", type="primary"):
-            utils.delete_chat_records(cursor, db)
+            utils.delete_chat_records()
         if st.button("Reset summary", type="primary"):
-            utils.delete_summary_records(cursor, db)
+            utils.delete_summary_records()
         if st.button("Reset detailed Plan", type="primary"):
-            utils.delete_plan_records(cursor,db)
+            utils.delete_plan_records()
 
 if __name__ == "__main__":
     st.set_page_config(page_title='Todolist', page_icon=':memo:', initial_sidebar_state='expanded', layout='wide', menu_items={'Report a Bug':'https://forms.gle/C8Zv8hzvYhPPvDW16'})
     utils.check_if_user_loggedin()
     utils.initialize_previous_messages()
     utils.initialise_ui_layout_todolist_page()
-    db, cursor = db_funcs.initialize_database()
-    llm_utils.initialise_model_setup()
     initialise_side_bar_components()
     col_1, col_2 = st.columns([0.7,0.3])
     
@@ -63,31 +60,35 @@ if __name__ == "__main__":
         st.subheader("SMART ASSISTANT")
         a = st.container(height=600)
         with a:
+            if st.session_state.get('has_older_messages') and st.button("Load older messages"):
+                utils.load_older_messages()
             for message in st.session_state['display_messages']:
                 with st.chat_message(message["role"]):
                     st.markdown(message["parts"][0])
 
         if prompt:= st.chat_input("How do i train for a marathon in 6 months, i can run 3 days a week"):
-            message_count = utils.cached_get_message_count(st.session_state['user_info']['email'], datetime.timedelta(minutes=st.session_state['timeframe']))
-            logger.debug(f"User {st.session_state['user_info']['name']} reached {message_count} messages")
-            if message_count <= st.session_state['rate_limit']:
+            limiter = rate_limiter.get_rate_limiter(st.session_state['rate_limit'], st.session_state['timeframe'])
+            if limiter.try_acquire(st.session_state['user_info']['email']):
                 with a:
                     st.chat_message("user").markdown(prompt)
                 st.session_state['messages'].append({"role":"user", "parts": [prompt]})
                 st.session_state['display_messages'].append({"role":"user", "parts": [prompt]})
-                db_funcs.save_chat_message(cursor, db, st.session_state['user_info']['email'], "user", prompt) 
-                with a:
-                    with st.spinner("Generating response... please wait"):
-                        response = llm_utils.generate_response(messages=st.session_state['messages'], model=st.session_state['chat_model'], db=db, cursor=cursor)
-                    with st.chat_message("model"):
-                        st.markdown(response.text)
-                # Add assistant response to chat history
-                st.session_state['messages'].append({"role":"model", "parts": [response.text]})
-                st.session_state['display_messages'].append({"role":"model", "parts": [response.text]})
-                db_funcs.save_chat_message(cursor, db, st.session_state['user_info']['email'], "model", response.text)
+                response_text = None
+                try:
+                    with a:
+                        response_stream = llm_utils.generate_response(context=st.session_state['messages'], model=llm_utils.get_model('chat'), stream=True)
+                        with st.chat_message("model"):
+                            response_text = st.write_stream(response_stream)
+                    # Add assistant response to chat history
+                    st.session_state['messages'].append({"role":"model", "parts": [response_text]})
+                    st.session_state['display_messages'].append({"role":"model", "parts": [response_text]})
+                finally:
+                    # Both messages of the turn are saved together once the response has been shown,
+                    # the user's message is still saved if generating the response failed.
+                    utils.save_chat_turn(prompt, response_text)
             else: 
-                st.toast("Rate limit of 10 exceeded. Please try again later.")
+                st.toast(f"Rate limit of {st.session_state['rate_limit']} exceeded. Please try again later.")
     with col_2:
-        column_2._contents_of_column_2(db,cursor)
+        column_2._contents_of_column_2()
     logger.debug(f"tasks are generated: {st.session_state['task_ids_generated']}")
     logger.debug(f"st.session_state['goal_title'] = {st.session_state['goal_title']}")
\ No newline at end of file
@@ -0,0 +1,85 @@
+"""Checks that the chat_messages queries are answered with the indexes added by the migrations.
+
+Runs against the database in DATABASE_URL, in a throwaway schema, and is skipped when it isn't set.
+"""
+import datetime
+import os
+import uuid
+
+import pytest
+
+psycopg2 = pytest.importorskip("psycopg2")
+pytest.importorskip("streamlit")
+
+import helper.database_functions as db_funcs
+from helper.migrations import run_migrations
+
+DATABASE_URL = os.environ.get("DATABASE_URL")
+pytestmark = pytest.mark.skipif(not DATABASE_URL, reason="DATABASE_URL is not set")
+
+
+class _RecordingCursor:
+    """
+    Records the statements a database function executes, so they can be explained instead of run.
+    """
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, sql, params=None):
+        self.statements.append((sql, params))
+
+    def fetchall(self):
+        return []
+
+    def fetchone(self):
+        return None
+
+
+@pytest.fixture
+def cursor():
+    connection = psycopg2.connect(DATABASE_URL)
+    cursor = connection.cursor()
+    schema = f"test_indexes_{uuid.uuid4().hex[:12]}"
+    cursor.execute(f"CREATE SCHEMA {schema}")
+    cursor.execute(f"SET search_path TO {schema}")
+    connection.commit()
+    try:
+        run_migrations(connection)
+        cursor = connection.cursor()
+        # 50 users with 100 messages each, one message every 50 minutes per user.
+        cursor.execute("INSERT INTO users (email) SELECT 'user' || n || '@example.com' FROM generate_series(1, 50) n")
+        cursor.execute('''
+            INSERT INTO chat_messages (email, role, parts, timestamp)
+            SELECT 'user' || (n % 50 + 1) || '@example.com',
+                   CASE WHEN n % 2 = 0 THEN 'user' ELSE 'model' END,
+                   '["hello"]',
+                   CURRENT_TIMESTAMP - n * INTERVAL '1 minute'
+            FROM generate_series(1, 5000) n
+        ''')
+        cursor.execute("ANALYZE chat_messages")
+        cursor.execute("SET enable_seqscan = off")
+        yield cursor
+    finally:
+        connection.rollback()
+        connection.cursor().execute(f"DROP SCHEMA {schema} CASCADE")
+        connection.commit()
+        connection.close()
+
+
+def _explain(cursor, function, *args) -> str:
+    recorder = _RecordingCursor()
+    function(recorder, *args)
+    sql, params = recorder.statements[-1]
+    cursor.execute(f"EXPLAIN {sql}", params)
+    return "\n".join(row[0] for row in cursor.fetchall())
+
+
+def test_history_query_uses_email_id_index(cursor):
+    plan = _explain(cursor, db_funcs.get_user_chat_messages, "user1@example.com")
+    assert "chat_messages_email_id_idx" in plan, plan
+
+
+def test_messages_after_summary_timestamp_use_email_timestamp_index(cursor):
+    timestamp = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(minutes=10)
+    plan = _explain(cursor, db_funcs.get_user_chat_messages, "user1@example.com", timestamp)
+    assert "chat_messages_email_timestamp_idx" in plan, plan
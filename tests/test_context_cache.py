@@ -0,0 +1,85 @@
+"""Drives the context cache through the local store."""
+import pytest
+
+pytest.importorskip("streamlit")
+pytest.importorskip("google.generativeai")
+pytest.importorskip("logzero")
+
+import helper.context_cache as context_cache
+import helper.token_estimator as token_estimator
+
+SPEC = {"model_name": "gemini-1.5-flash", "system_instruction": "You are a Smart Assistant."}
+SUMMARY = [{"role": "model", "parts": ["The user trains for a marathon, 3 days a week."]}]
+
+
+class _FakeModel:
+    def __init__(self, **spec):
+        self.spec = spec
+        self.requests = []
+
+    def generate_content(self, contents, **kwargs):
+        self.requests.append(list(contents))
+        return "response"
+
+
+class _CountingStore(context_cache.LocalContextStore):
+    def __init__(self):
+        self.created = 0
+        self.deleted = 0
+
+    def create(self, spec, contents, ttl, api_key):
+        self.created += 1
+        _, model = super().create(spec, contents, ttl, api_key)
+        return self.created, model
+
+    def delete(self, handle):
+        self.deleted += 1
+
+
+@pytest.fixture(autouse=True)
+def _local_models(monkeypatch):
+    monkeypatch.setattr(context_cache.genai, "GenerativeModel", _FakeModel)
+    monkeypatch.setattr(context_cache.genai_clients, "get_client", lambda api_key: f"client of {api_key}")
+    monkeypatch.setattr(token_estimator, "get_token_estimator", lambda: token_estimator.TokenEstimator(calibrate_every=0))
+
+
+def test_prefix_is_sent_by_the_cached_model():
+    cache = context_cache.ContextCache(_CountingStore())
+    model = cache.model_for("chat", SPEC, SUMMARY, "key")
+    model.generate_content([{"role": "user", "parts": ["hi"]}])
+    assert model.requests == [SUMMARY + [{"role": "user", "parts": ["hi"]}]]
+    assert model.spec == SPEC
+    assert model._client == "client of key"
+
+
+def test_cached_model_is_reused_per_prefix_and_api_key():
+    store = _CountingStore()
+    cache = context_cache.ContextCache(store)
+    model = cache.model_for("chat", SPEC, SUMMARY, "key")
+    assert cache.model_for("chat", SPEC, SUMMARY, "key") is model
+    assert cache.model_for("chat", SPEC, [], "key") is not model
+    assert cache.model_for("chat", SPEC, SUMMARY, "other key") is not model
+    assert store.created == 3
+
+
+def test_small_prefixes_are_not_cached():
+    store = _CountingStore()
+    cache = context_cache.ContextCache(store, min_tokens=10_000)
+    assert cache.model_for("chat", SPEC, SUMMARY, "key") is None
+    assert store.created == 0
+
+
+def test_prefixes_about_to_expire_are_uploaded_again():
+    store = _CountingStore()
+    cache = context_cache.ContextCache(store, ttl_in_secs=context_cache.REFRESH_MARGIN_IN_SECS)
+    first = cache.model_for("chat", SPEC, SUMMARY, "key")
+    assert cache.model_for("chat", SPEC, SUMMARY, "key") is not first
+    assert store.created == 2
+
+
+def test_least_recently_used_prefix_is_deleted():
+    store = _CountingStore()
+    cache = context_cache.ContextCache(store, max_entries=1)
+    cache.model_for("chat", SPEC, SUMMARY, "key")
+    cache.model_for("plan", SPEC, [], "key")
+    assert store.deleted == 1